@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Micro-benchmarks of the grading pipeline, run `python benchmark.py -h`
+import os
+import sys
+import glob
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+
+import xlrd
+import xlwt
+
+import match
+import report
+import similarity
+
+
+def random_text(n: int, seed: int = 0):
+    rnd = random.Random(seed)
+    alphabet = 'abcdefghij0123456789 \n一二三四五六七八九十'
+    return ''.join(rnd.choice(alphabet) for i in range(n))
+
+
+def mutate(s: str, rate: float = 0.05, seed: int = 1):
+    # insert, delete and replace some characters
+    rnd = random.Random(seed)
+    L = list(s)
+    for i in range(int(len(L)*rate)):
+        p = rnd.randrange(len(L))
+        op = rnd.random()
+        if op < 0.3:
+            L.insert(p, random_text(rnd.randint(1, 20), seed=p))
+        elif op < 0.6:
+            del L[p:p+rnd.randint(1, 20)]
+        else:
+            L[p] = random_text(1, seed=p)
+    return ''.join(L)
+
+
+def bench_dp(args):
+    # (name, align function, estimated bytes per matrix cell)
+    # DP: a reflected list of int64 scores and a list of (int64,int64) tuples
+    # array: a single uint8 traceback code
+    paths = [('dp', lambda A, B: match.align(A, B, 'dp'), 8+16),
+             ('array', lambda A, B: match.align(A, B, 'array'), 1)]
+    for name, func, _ in paths:
+        func('warm', 'up')  # JIT compile
+    print(f'{"length":>8}\t{"path":>6}\t{"time":>8}\t{"Mcells/s":>8}\t{"matrix MB":>9}')
+    for n in args.lengths:
+        B = random_text(n)
+        A = mutate(B)
+        cells = (len(A)+1)*(len(B)+1)
+        results = []
+        for name, func, cell_bytes in paths:
+            t = min(timeit(func, A, B) for i in range(args.repeat))
+            results.append(func(A, B))
+            print(f'{n:>8}\t{name:>6}\t{t:>7.3f}s\t{cells/t/1e6:>8.1f}\t{cells*cell_bytes/2**20:>9.1f}')
+        assert(all(r == results[0] for r in results))
+
+
+STARTUP_SCRIPT = """
+import time
+t0 = time.perf_counter()
+import match
+t1 = time.perf_counter()
+match.align('1+1=2', '1+1=  ', '{engine}')
+t2 = time.perf_counter()
+print(t1-t0, t2-t1)
+"""
+
+
+def bench_startup(args):
+    # fresh interpreters, as a pool worker or a one-file regrade would start
+    root = os.path.dirname(os.path.abspath(__file__))
+    if args.clean:
+        for f in glob.glob(os.path.join(root, '__pycache__', 'match.*.nb[ic]')):
+            os.remove(f)
+    print(f'{"engine":>6}\t{"run":>4}\t{"import":>8}\t{"first call":>10}')
+    for engine in args.engines:
+        for run in range(args.repeat):
+            out = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT.format(engine=engine)],
+                                 cwd=root, capture_output=True, text=True, check=True).stdout
+            t_import, t_call = map(float, out.split())
+            print(f'{engine:>6}\t{run:>4}\t{t_import:>7.3f}s\t{t_call:>9.3f}s')
+
+
+def legacy_report(result_path, rsheet, studentID, result, long_term_log):
+    # the result.xls loop before report.py: list.index per row, a cell by cell copy, a write per log
+    log_path = os.path.join(result_path, 'log')
+    wbk = xlwt.Workbook()
+    wsheet = wbk.add_sheet(rsheet.name, cell_overwrite_ok=True)
+    for i in range(rsheet.nrows):
+        for j in range(rsheet.ncols):
+            wsheet.write(i, j, rsheet.cell(i, j).value)
+    for i in range(rsheet.nrows):
+        id = rsheet.cell(i, 1).value
+        if id in studentID:
+            D = result[studentID.index(id)]
+            wsheet.write(i, 4, D['score'])
+            md5 = report.log_md5(D['log'])
+            with open(os.path.join(log_path, md5), 'wb') as w:
+                w.write(str.encode(D['log'], encoding='utf-8'))
+            wsheet.write(i, 5, long_term_log.replace('{md5}', md5))
+    wbk.save(os.path.join(result_path, 'result.xls'))
+
+
+def bench_report(args):
+    # a roster of n students, a submission for 90% of them and 20 distinct logs
+    rnd = random.Random(0)
+    folder = tempfile.mkdtemp()
+    wbk = xlwt.Workbook()
+    sheet = wbk.add_sheet('sheet1')
+    ids = [str(2019000000+i) for i in range(args.students)]
+    for j, title in enumerate(['id', 'studentID', 'name', 'state', 'score', 'log']):
+        sheet.write(0, j, title)
+    for i in range(len(ids)):
+        for j, value in enumerate([f'hw{i}', ids[i], f'name{i}', 'submitted', '', '']):
+            sheet.write(i+1, j, value)
+    wbk.save(os.path.join(folder, 'template.xls'))
+    rsheet = xlrd.open_workbook(os.path.join(folder, 'template.xls')).sheet_by_index(0)
+    studentID = rnd.sample(ids, len(ids)*9//10)
+    logs = [random_text(args.log_size, seed=k) for k in range(20)]
+    result = [{'score': rnd.randint(0, 100), 'log': rnd.choice(logs)} for i in studentID]
+    paths = [('legacy', lambda path: legacy_report(path, rsheet, studentID, result, '{md5}'))]
+    for fmt in report.FORMATS:
+        if fmt != 'xlsx' or report.openpyxl is not None:
+            paths.append((fmt, lambda path, fmt=fmt: report.write_result(
+                path, report.open_logs(path), rsheet, studentID, result, '{md5}', [fmt])))
+    print(f'{"students":>8}\t{"path":>6}\t{"time":>8}')
+    for name, func in paths:
+        t = []
+        for run in range(args.repeat):
+            path = os.path.join(folder, f'{name}{run}')
+            os.makedirs(os.path.join(path, 'log'))
+            t.append(timeit(func, path))
+        print(f'{args.students:>8}\t{name:>6}\t{min(t):>7.3f}s')
+    new = xlrd.open_workbook(os.path.join(folder, 'xls0', 'result.xls')).sheet_by_index(0)
+    old = xlrd.open_workbook(os.path.join(folder, 'legacy0', 'result.xls')).sheet_by_index(0)
+    assert(all(new.row_values(i) == old.row_values(i) for i in range(old.nrows)))
+
+
+def bench_similarity(args):
+    # n submissions of 10 random answers and a common one, every 100th copied with 2% edits
+    rnd = random.Random(0)
+    submissions = dict()
+    for u in range(args.submissions):
+        submissions[f'u{u:05d}'] = [(str(t), random_text(rnd.randint(50, 400), seed=u*100+t)) for t in range(10)] + \
+            [('common', 'the common correct answer')]
+    copies = 0
+    for u in range(0, args.submissions, 100):
+        submissions[f'copy{u:05d}'] = [(t, mutate(x, 0.02, seed=u))
+                                       for t, x in submissions[f'u{u:05d}']]
+        copies += 1
+    similarity.find_similar({'warm': [('1', 'up up up')], 'up': [('1', 'up up up')]},
+                            engine=args.engine)  # JIT compile
+    t = time.perf_counter()
+    found = similarity.find_similar(submissions, engine=args.engine)
+    t = time.perf_counter()-t
+    print(f'{len(submissions)} submissions\t{t:.3f}s\t{len(found)}/{copies} copies found')
+
+
+def timeit(func, *args):
+    t = time.perf_counter()
+    func(*args)
+    return time.perf_counter()-t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser(
+        'dp', help='DP on nested lists against ArrayDP on NumPy arrays.')
+    p.add_argument('-l', '--lengths', type=int, nargs='+',
+                   default=[500, 1000, 2000, 4000, 8000])
+    p.add_argument('-r', '--repeat', type=int, default=3)
+    p.set_defaults(func=bench_dp)
+    p = subparsers.add_parser(
+        'startup', help='import and first-call latency of match in a new process.')
+    p.add_argument('-e', '--engines', type=str, nargs='+',
+                   default=match.ENGINES, choices=match.ENGINES)
+    p.add_argument('-r', '--repeat', type=int, default=2)
+    p.add_argument('--clean', action='store_true',
+                   help='remove the kernel cache first, the first run compiles.')
+    p.set_defaults(func=bench_startup)
+    p = subparsers.add_parser(
+        'report', help='result.xls and logs of a large roster, list.index against report.py.')
+    p.add_argument('-n', '--students', type=int, default=5000)
+    p.add_argument('--log-size', type=int, default=2000)
+    p.add_argument('-r', '--repeat', type=int, default=3)
+    p.set_defaults(func=bench_report)
+    p = subparsers.add_parser(
+        'similarity', help='MinHash/LSH similarity stage on random submissions with planted copies.')
+    p.add_argument('-n', '--submissions', type=int, default=3000)
+    p.add_argument('-e', '--engine', type=str, default='array', choices=match.ENGINES)
+    p.set_defaults(func=bench_similarity)
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# Long-running grading service: keeps parsed tasks and JIT-compiled workers warm.
+#   python daemon.py [-p 8090] serve [-j 8]
+#   python daemon.py [-p 8090] grade -w {PATH} [files ...]
+import os
+import glob
+import json
+import argparse
+import multiprocessing
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.request import urlopen, Request
+
+import main
+import match
+from parsecache import ParseCache
+from report import open_logs
+
+# (working folder, Workdir.signature) whose spj is loaded in this worker process
+worker_root = None
+
+
+def warm_worker(engine: str):
+    # pool initializer: compile the alignment kernel once per worker
+    match.align('warm', 'up', engine)
+
+
+def grade_worker(job):
+    """
+    main.stream_worker, after loading the spj of the job's working folder.
+    """
+    global worker_root
+    root = job[0][0]
+    if worker_root != job[0]:
+        # another folder, or one of its files changed: the memo and spj may be stale
+        vars(main).pop('spj', None)
+        main.answer_cache.clear()
+        main.load_spj(root)
+        worker_root = job[0]
+    # see the MANNAL grades typed in main.py since the last job
+    main.mannal.caches.clear()
+    return main.stream_worker(job[1:])
+
+
+class Workdir:
+    """
+    Parsed answer.docx and settings.json of a working folder,
+    reloaded when one of them or program/spj.py changes.
+    """
+
+    def __init__(self, root: str, options: tuple):
+        self.root = root
+        self.options = options
+        self.signature = None
+        self.reload()
+
+    def files_signature(self):
+        # program/spj.py is optional, None while it does not exist
+        return tuple(os.path.getmtime(os.path.join(self.root, name)) if os.path.exists(os.path.join(self.root, name)) else None
+                     for name in ('answer.docx', 'settings.json', 'program/spj.py'))
+
+    def reload(self):
+        signature = self.files_signature()
+        if signature != self.signature:
+            self.answer, self.settings, self.tasks = main.load_workdir(
+                self.root)
+            self.result_path = os.path.join(self.root, 'result')
+            main.create_folder(self.result_path)
+            self.step1_cache = ParseCache(os.path.join(self.result_path, 'parse_cache'),
+                                          self.answer, self.options)
+            self.signature = signature
+            print('load workdir:', self.root)
+
+
+class GradingService:
+    def __init__(self, processes: int, options: tuple, pack: bool = False):
+        self.options = options
+        self.pack = pack
+        self.workdirs = dict()
+        self.pool = multiprocessing.Pool(
+            processes, initializer=warm_worker, initargs=(options[0],))
+
+    def workdir(self, root: str):
+        if root not in self.workdirs:
+            self.workdirs[root] = Workdir(root, self.options)
+        else:
+            self.workdirs[root].reload()
+        return self.workdirs[root]
+
+    def grade(self, root: str, files):
+        """
+        files:        docx paths, every file in {root}/data by default
+        return:       List[Dict:{'file':str,'score':float,'md5':str}], if some MANNAL tasks
+                      are not in mannal.json yet, they are listed in 'pending' instead of 'md5'
+                      and 'score' only sums the graded tasks
+        """
+        root = os.path.abspath(root)
+        w = self.workdir(root)
+        # opened for every request, main.py may write logs meanwhile
+        logs = open_logs(w.result_path, self.pack)
+        if not files:
+            files = glob.glob(os.path.join(root, 'data', '*.*'))
+        files = [os.path.abspath(f) for f in files]
+        userids = [os.path.splitext(os.path.basename(f))[0] for f in files]
+        jobs = [((root, w.signature), i, files[i], userids[i], w.answer, w.result_path, w.tasks, w.step1_cache, self.options)
+                for i in range(len(files))]
+        response = [None]*len(files)
+        for i, key, data, results, stats in self.pool.imap_unordered(grade_worker, jobs):
+            if results is None:
+                # parse user.docx error
+                response[i] = {'file': files[i], 'score': data['score'],
+                               'md5': logs.put(data['log'])}
+                continue
+            pending = [r['pending'] for r in results if 'pending' in r]
+            if len(pending) > 0:
+                # the log is written once the MANNAL tasks are graded by main.py
+                response[i] = {'file': files[i], 'score': sum(r['score'] for r in results),
+                               'pending': pending}
+                continue
+            D = main.summarize(files[i], userids[i], results)
+            response[i] = {'file': files[i], 'score': D['score'],
+                           'md5': logs.put(D['log'])}
+        return response
+
+
+def make_handler(service: GradingService):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            """
+            POST /grade {"workdir":str,"files":[str,...]}
+            """
+            if self.path != '/grade':
+                self.send_error(404)
+                return
+            try:
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                job = json.loads(body)
+                result = {'results': service.grade(
+                    job['workdir'], job.get('files', []))}
+                code = 200
+            except Exception as e:
+                result = {'error': repr(e)}
+                code = 500
+            data = json.dumps(result, ensure_ascii=False).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+    return Handler
+
+
+def serve(args):
+    service = GradingService(
+        args.jobs, (args.engine, args.band, args.anchor), args.pack)
+    server = HTTPServer(('127.0.0.1', args.port), make_handler(service))
+    print(f'Grading service on http://127.0.0.1:{args.port}/grade')
+    server.serve_forever()
+
+
+def grade(args):
+    job = {'workdir': os.path.abspath(args.workdir),
+           'files': [os.path.abspath(f) for f in args.files]}
+    request = Request(f'http://127.0.0.1:{args.port}/grade', data=json.dumps(job).encode('utf-8'),
+                      headers={'Content-Type': 'application/json'})
+    result = json.loads(urlopen(request).read())
+    if 'error' in result:
+        print('Error:', result['error'])
+        return
+    for r in result['results']:
+        line = f'{os.path.basename(r["file"])}\t{r["score"]}\t'
+        if 'pending' in r:
+            line += 'MANNAL pending:'+','.join(r['pending'])
+        else:
+            line += r['md5']
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=8090)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser('serve', help='start the grading service.')
+    p.add_argument('-j', '--jobs', type=int, default=16,
+                   help='worker processes.')
+    p.add_argument('-e', '--engine', type=str, default='dp', choices=match.ENGINES,
+                   help='sequence alignment engine of step 1.')
+    p.add_argument('--band', type=int, default=256,
+                   help='half width of the diagonal band for the banded engine.')
+    p.add_argument('--anchor', action='store_true',
+                   help='align only the gaps between exact-match anchors.')
+    p.add_argument('--pack', action='store_true',
+                   help='write the logs to result/log.pack instead of result/log/{md5} files.')
+    p.set_defaults(func=serve)
+    p = subparsers.add_parser(
+        'grade', help='grade files against a working folder.')
+    p.add_argument('-w', '--workdir', type=str, required=True,
+                   help='working folder path.')
+    p.add_argument('files', nargs='*',
+                   help='docx files, every file in the data folder by default.')
+    p.set_defaults(func=grade)
+    args = parser.parse_args()
+    args.func(args)
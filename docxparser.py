@@ -3,6 +3,7 @@
 # Modified copy of docx2txt
 
 import argparse
+import io
 import re
 import xml.etree.ElementTree as ET
 import zipfile
@@ -54,93 +55,220 @@ def qn(tag):
     return '{{{}}}{}'.format(uri, tagroot)
 
 
+W_T, W_TAB, W_BR, W_CR, W_P = (qn(tag) for tag in ('w:t', 'w:tab', 'w:br', 'w:cr', 'w:p'))
+tag_tokens = {W_TAB: '\t', W_BR: '\n', W_CR: '\n', W_P: '\n\n'}
+
+
+def tag_token(tag):
+    """
+    Text emitted at the start of an element, memoized per qualified tag name.
+    """
+    token = tag_tokens.get(tag)
+    if token is None:
+        tagroot = tag.split('}')[-1]
+        if tagroot == 'graphic':
+            token = graphic_token
+        elif 'grid' in tagroot.lower() and tagroot != 'snapToGrid':
+            token = '{'+tagroot+'}'
+        else:
+            token = ''
+        tag_tokens[tag] = token
+    return token
+
+
 def xml2text(xml):
     """
     A string representing the textual content of this run, with content
     child elements like ``<w:tab/>`` translated to their Python
     equivalent.
+    xml: bytes or a binary file object, parsed as a stream with every
+    element dropped from the tree once it is processed.
     Adapted from: https://github.com/python-openxml/python-docx/
     """
-    text = u''
-    root = ET.fromstring(xml)
-    for child in root.iter():
-        tagroot = child.tag.split('}')[-1]
-        if child.tag == qn('w:t'):
-            t_text = child.text
-            text += t_text if t_text is not None else ''
-        elif child.tag == qn('w:tab'):
-            text += '\t'
-        elif child.tag in (qn('w:br'), qn('w:cr')):
-            text += '\n'
-        elif child.tag == qn("w:p"):
-            text += '\n\n'
-        elif tagroot == 'graphic':
-            text += graphic_token
-        elif 'grid' in tagroot.lower() and tagroot!='snapToGrid':
-            text += '{'+tagroot+'}'
+    if isinstance(xml, (bytes, bytearray, memoryview)):
+        xml = io.BytesIO(xml)
+    text = []
+    stack = []
+    for event, elem in ET.iterparse(xml, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            if elem.tag != W_T:
+                token = tag_token(elem.tag)
+                if token:
+                    text.append(token)
         else:
-            continue
-            ignore = {'document', 'body', 'pPr', 'jc', 'rPr', 'rFonts', 'b', 'bCs', 'docGrid', 'sz',
-                      'szCs', 'r', 'color', 'pStyle', 'numPr', 'ilvl', 'numId', 'ind', 'tbl', 'tblPr', 'tblStyle',
-                      'tblW', 'tblBorders', 'left', 'right', 'gridCol', 'tblLook', 'tr', 'trPr', 'tc', 'tcPr', 'tcW', 'i', 'iCs',
-                      'tblInd'}  # ,'lang','noProof','drawing','inline','extent','effectExtent','docPr','cNvGraphicFramePr',
-            #'graphicFrameLocks','graphic','graphicData','pic','nvPicPr','cNvPr','cNvPicPr','blipFill'}
-            suffix = text[-20:]
-            if tagroot not in ignore:
-                #print(child.tag)
-                log = ' keys:'+repr(child.keys())+' items:' + \
-                    repr(child.items())+' attrib:'+repr(child.attrib)
-                #text += '{'+tagroot+(' text:'+str(child.text) if child.text else '')+(' tail:'+str(child.tail) if child.tail else '')+log+'}'
-    return text
+            stack.pop()
+            if elem.tag == W_T and elem.text is not None:
+                text.append(elem.text)
+            elem.clear()
+            if len(stack) > 0:
+                stack[-1].remove(elem)
+    return ''.join(text)
+
+
+HEADER_XML = re.compile('word/header[0-9]*.xml')
+FOOTER_XML = re.compile('word/footer[0-9]*.xml')
+DOCUMENT_XML = 'word/document.xml'
+IMAGE_ID = re.compile(r'word/media/image(\d+)\..+?')
+# bytes allocated ahead for a zip member, its declared size is not trusted beyond this
+MEMBER_PREALLOC = 1 << 24
+
+
+class DocxZip:
+    """
+    Members of a docx classified in one pass over the zip central directory:
+    headers and footers (in zip order), the document and the images (by image id,
+    images without a single numeric id after them by name).
+    XML members are opened as streams and images read into a single buffer,
+    a member is never held twice in memory.
+    """
+
+    def __init__(self, docx):
+        self.zipf = zipfile.ZipFile(docx)
+        self.headers, self.footers, images = [], [], []
+        self.document = None
+        for info in self.zipf.infolist():
+            name = info.filename
+            if HEADER_XML.match(name):
+                self.headers.append(info)
+            elif FOOTER_XML.match(name):
+                self.footers.append(info)
+            elif name == DOCUMENT_XML:
+                self.document = info
+            elif 'word/media/image' in name:
+                imgid = IMAGE_ID.findall(name)
+                key = (0, int(imgid[0]), name) if len(imgid) == 1 else (1, 0, name)
+                images.append((key, info))
+        self.images = [info for key, info in sorted(
+            images, key=lambda x: x[0])]
+
+    def open(self, info):
+        # binary stream of the member, decompressed on the fly
+        return self.zipf.open(info)
+
+    def read(self, info):
+        """
+        return:       bytearray of the member, filled in place with readinto
+        """
+        return read_member(self.zipf, info)
+
+    def close(self):
+        self.zipf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_member(zipf, info):
+    """
+    return:       bytearray of a zip member, np.frombuffer and cv2.imdecode use it without a copy,
+                  zipfile.BadZipFile if its size is not the one declared in the zip
+    """
+    if isinstance(info, str):
+        info = zipf.getinfo(info)
+    # grown as the bytes arrive, a forged header does not allocate its declared size
+    data = bytearray(min(info.file_size, MEMBER_PREALLOC))
+    n = 0
+    with zipf.open(info) as f:
+        while True:
+            if n == len(data):
+                data.extend(bytes(max(n, 1 << 16)))
+            with memoryview(data) as view:
+                k = f.readinto(view[n:])
+            if k == 0:
+                break
+            n += k
+    del data[n:]
+    if n != info.file_size:
+        raise zipfile.BadZipFile(
+            f'{info.filename}: {n} bytes, {info.file_size} declared')
+    return data
+
+
+class LazyImage:
+    """
+    Handle of an image inside a docx. Only the path of the docx and the name
+    of the zip member are kept (or the raw bytes if the docx is not a file on
+    disk), the image is decoded and resized when load() is first called.
+    """
+
+    def __init__(self, docx, member: str, data: bytes = None):
+        self.docx = docx
+        self.member = member
+        self.data = data
+        self.img = None
+
+    def read(self):
+        # raw bytes of the image file, a bytes-like object
+        if self.data is not None:
+            return self.data
+        with zipfile.ZipFile(self.docx) as zipf:
+            return read_member(zipf, self.member)
+
+    def load(self, size: int = 800):
+        """
+        return:  cv2::img fitted into size x size, None if it can not be decoded
+        """
+        if self.img is None:
+            try:
+                binary = np.frombuffer(self.read(), np.uint8)
+            except zipfile.BadZipFile:
+                return None
+            img = cv2.imdecode(binary, cv2.IMREAD_ANYCOLOR)
+            if img is None:
+                return None
+            n, m = img.shape[:2]
+            tn, tm = size, size
+            r = min(tn/n, tm/m)
+            tn, tm = int(n*r), int(m*r)
+            self.img = cv2.resize(img, (tm, tn))
+        return self.img
+
+    def release(self):
+        # drop the decoded pixels, load() decodes again
+        self.img = None
+
+    def __getstate__(self):
+        # never send decoded pixels through pipes or caches
+        state = self.__dict__.copy()
+        state['img'] = None
+        return state
+
+    def __repr__(self):
+        return f'LazyImage({self.member})'
 
 
 def process(docx):
-    # return (text:str,imgs:List[cv2::img])
+    # return (text:str,imgs:List[LazyImage])
     text = u''
 
-    # unzip the docx in memory
-    zipf = zipfile.ZipFile(docx)
-    filelist = zipf.namelist()
-
-    # get header text
-    # there can be 3 header files in the zip
-    header_xmls = 'word/header[0-9]*.xml'
-    for fname in filelist:
-        if re.match(header_xmls, fname):
-            text += xml2text(zipf.read(fname))
-
-    # get main text
-    doc_xml = 'word/document.xml'
-    text += xml2text(zipf.read(doc_xml))
-
-    # get footer text
-    # there can be 3 footer files in the zip
-    footer_xmls = 'word/footer[0-9]*.xml'
-    for fname in filelist:
-        if re.match(footer_xmls, fname):
-            text += xml2text(zipf.read(fname))
-
-    imgList = []
-    # extract images
-    imgfile = [s for s in filelist if 'word/media/image' in s]
-    # for fname in filelist:
-    #     _, extension = os.path.splitext(fname)
-    #     if extension in [".jpg", ".jpeg", ".png", ".bmp", ".tiff"]:
-    for fname in imgfile:
-        binary = np.frombuffer(zipf.read(fname), np.uint8)
-        img = cv2.imdecode(binary, cv2.IMREAD_ANYCOLOR)
-        n, m, _ = img.shape
-        tn, tm = 800, 800
-        r = min(tn/n, tm/m)
-        tn, tm = int(n*r), int(m*r)
-        img = cv2.resize(img, (tm, tn))
-        imgid = re.findall(r'word/media/image(\d+)\..+?', fname)
-        assert(len(imgid) == 1)
-        imgid = int(imgid[0])
-        imgList.append((imgid, img))
-    imgList = sorted(imgList, key=lambda x: x[0])
-    imgList = [img for id, img in imgList]
-    zipf.close()
+    with DocxZip(docx) as zipf:
+        # get header text
+        # there can be 3 header files in the zip
+        for info in zipf.headers:
+            with zipf.open(info) as f:
+                text += xml2text(f)
+
+        # get main text
+        with zipf.open(zipf.document or DOCUMENT_XML) as f:
+            text += xml2text(f)
+
+        # get footer text
+        # there can be 3 footer files in the zip
+        for info in zipf.footers:
+            with zipf.open(info) as f:
+                text += xml2text(f)
+
+        # images are only named here, LazyImage reads them when needed
+        imgList = []
+        for info in zipf.images:
+            if isinstance(docx, str):
+                imgList.append(LazyImage(docx, info.filename))
+            else:
+                imgList.append(LazyImage(None, info.filename, zipf.read(info)))
     return (text.strip(), imgList)
 
 
@@ -151,7 +279,7 @@ if __name__ == '__main__':
     print(text[0])
     for i in range(len(text[1])):
         print('img', i)
-        cv2.imshow('img', text[1][i])
+        cv2.imshow('img', text[1][i].load())
         cv2.waitKey(0)
     with open('test.out', 'w', encoding='utf-8') as w:
         w.write(repr(text[0]))
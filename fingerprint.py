@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Perceptual hashes (dHash) of the images of every submission, to find screenshots copied between students.
+import os
+import json
+import zipfile
+import multiprocessing
+from typing import List, Tuple
+
+import numpy as np
+import cv2
+
+from docxparser import DocxZip
+from parsecache import file_hash
+
+# number of set bits of every byte, for numpy without bitwise_count
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def dhash(data, size: int = 8):
+    """
+    data:         bytes-like object of an image file
+    return:       int, size*size bits: is each pixel of a (size+1) x size grayscale
+                  thumbnail darker than its right neighbour. None if it can not be decoded
+    """
+    binary = np.frombuffer(data, np.uint8)
+    # full scale, the reduced JPEG/PNG decoders alias enough to move a rescaled copy by several bits
+    img = cv2.imdecode(binary, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    small = cv2.resize(img, (size+1, size),
+                       interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def docx_hashes(docx: str):
+    """
+    return:       Dict:{member: dHash} of the images of the docx
+    """
+    hashes = dict()
+    try:
+        zipf = DocxZip(docx)
+    except zipfile.BadZipFile:
+        # not a docx, step 1 reports it
+        return hashes
+    with zipf:
+        for info in zipf.images:
+            try:
+                h = dhash(zipf.read(info))
+            except (zipfile.BadZipFile, ValueError, NotImplementedError):
+                # a damaged or unsupported member, the other images are still compared
+                continue
+            if h is not None:
+                hashes[info.filename] = h
+    return hashes
+
+
+class HashCache:
+    """
+    result/imghash.json: the dHashes of every docx keyed by the hash of its bytes,
+    so a rerun only decodes the images of new or changed submissions.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data = dict()
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.data = json.load(f)
+        self.used = set()
+
+    def hashes(self, docxs: List[str], processes: int = 16):
+        """
+        return:       List[Dict:{member: dHash}], one for each docx
+        """
+        keys = [file_hash(docx) for docx in docxs]
+        todo = [i for i in range(len(docxs)) if keys[i] not in self.data]
+        if len(todo) > 0:
+            with multiprocessing.Pool(max(1, min(processes, len(todo)))) as p:
+                computed = p.map(docx_hashes, [docxs[i] for i in todo])
+            for i, hashes in zip(todo, computed):
+                self.data[keys[i]] = {name: format(h, '016x')
+                                      for name, h in hashes.items()}
+        self.used.update(keys)
+        return [{name: int(h, 16) for name, h in self.data[key].items()} for key in keys]
+
+    def save(self):
+        # entries of the submissions which are gone are dropped
+        data = {key: value for key, value in self.data.items()
+                if key in self.used}
+        tmp = self.path+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+
+def popcount(x: np.ndarray):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return POPCOUNT[x.view(np.uint8).reshape(x.shape+(8,))].sum(axis=-1)
+
+
+def near_pairs(hashes: np.ndarray, distance: int, chunk: int = 1024):
+    """
+    hashes:       np.ndarray of uint64
+    return:       List[(i, j)], i < j, Hamming distance of hashes[i] and hashes[j] <= distance
+    """
+    pairs = []
+    for i in range(0, len(hashes), chunk):
+        d = popcount(hashes[i:i+chunk, None] ^ hashes[None, :])
+        for a, b in zip(*np.nonzero(d <= distance)):
+            if i+a < b:
+                pairs.append((i+a, int(b)))
+    return pairs
+
+
+def find_duplicates(images: List[Tuple[str, str, int]], template: List[int], distance: int = 6):
+    """
+    images:       List[(userid, member, dHash)]
+    template:     dHashes of the images of answer.docx, images near them are not reported
+    return:       List[List[(userid, member)]], groups of near-duplicate images of two or more students,
+                  the largest first
+    """
+    if len(images) == 0:
+        return []
+    hashes = np.array([h for userid, member, h in images], dtype=np.uint64)
+    keep = np.ones(len(images), dtype=bool)
+    if len(template) > 0:
+        template = np.array(template, dtype=np.uint64)
+        keep = popcount(hashes[:, None] ^ template[None, :]).min(axis=1) > distance
+    index = np.nonzero(keep)[0]
+    parent = list(range(len(index)))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for a, b in near_pairs(hashes[index], distance):
+        if images[index[a]][0] != images[index[b]][0]:
+            parent[find(a)] = find(b)
+    components = dict()
+    for a in range(len(index)):
+        components.setdefault(find(a), []).append(images[index[a]][:2])
+    groups = [sorted(c) for c in components.values()
+              if len(set(userid for userid, member in c)) > 1]
+    return sorted(groups, key=lambda c: (-len(set(userid for userid, member in c)), c))
+
+
+def write_report(result_path: str, groups: List[List[Tuple[str, str]]], images: int, distance: int):
+    with open(os.path.join(result_path, 'images.txt'), 'w') as w:
+        w.write(f'Duplicate Images (dHash distance <= {distance}, {images} images):\n')
+        for k, group in enumerate(groups):
+            students = sorted(set(userid for userid, member in group))
+            w.write(f'  Group {k+1}: {len(students)} students\n')
+            for userid, member in group:
+                w.write(f'    {userid}\t{member}\n')
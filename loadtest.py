@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Load test of the log server (network.py), as every student refreshing their log at once.
+#   python loadtest.py [-p 8083] [-c 100] [-n 5000] --root {PATH}/result/log
+#   python loadtest.py [-p 8083] [-c 100] [-n 5000] --pack {PATH}/result/log
+# Connections are kept alive when the server allows it and reopened otherwise.
+import os
+import time
+import asyncio
+import argparse
+
+
+async def fetch(host, port, path, conn):
+    """
+    conn:         [reader, writer] of a kept-alive connection or [None, None], updated in place
+    return:       status code
+    """
+    if conn[0] is None:
+        conn[0], conn[1] = await asyncio.open_connection(host, port)
+    reader, writer = conn
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    headers = dict()
+    for line in lines[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+    if "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+    else:
+        # no length: the body ends with the connection
+        await reader.read()
+    if "content-length" not in headers or headers.get("connection", "").lower() == "close":
+        writer.close()
+        conn[0] = conn[1] = None
+    return int(lines[0].split()[1])
+
+
+async def client(host, port, paths, counter, latency, statuses):
+    conn = [None, None]
+    while counter[0] > 0:
+        counter[0] -= 1
+        path = paths[counter[0] % len(paths)]
+        t = time.perf_counter()
+        try:
+            status = await fetch(host, port, path, conn)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            status = 'error'
+            conn = [None, None]
+        latency.append(time.perf_counter()-t)
+        statuses[status] = statuses.get(status, 0)+1
+    if conn[1] is not None:
+        conn[1].close()
+
+
+async def run(args, paths):
+    counter = [args.requests]
+    latency, statuses = [], dict()
+    t = time.perf_counter()
+    await asyncio.gather(*[client(args.host, args.port, paths, counter, latency, statuses)
+                           for i in range(args.concurrency)])
+    total = time.perf_counter()-t
+    latency.sort()
+    print(f'requests: {len(latency)}\tconcurrency: {args.concurrency}\tstatus: {statuses}')
+    print(f'{len(latency)/total:.1f} requests/s\t'
+          f'p50 {latency[len(latency)//2]*1000:.2f}ms\t'
+          f'p99 {latency[min(len(latency)-1, len(latency)*99//100)]*1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', type=int, default=8083)
+    parser.add_argument('-c', '--concurrency', type=int, default=100)
+    parser.add_argument('-n', '--requests', type=int, default=5000)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--root', type=str,
+                       help='log folder served by the server, its md5 files are requested in turn.')
+    group.add_argument('--pack', type=str,
+                       help='packed log store served by the server, result/log for result/log.pack.')
+    args = parser.parse_args()
+    if args.pack is not None:
+        from logstore import LogStore
+        paths = ['/'+md5 for md5 in LogStore(args.pack).index]
+    else:
+        paths = ['/'+name for name in os.listdir(args.root) if len(name) == 32]
+    assert len(paths) > 0, 'no log in '+(args.pack or args.root)
+    asyncio.run(run(args, paths))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# The HTML page of a log, shared by report.py, network.py and the md5log view of web/, standard library only.
+import html
+
+
+def render_html(log: str):
+    # <pre> of the escaped log, the same page wherever it is rendered
+    return '<html><head><meta http-equiv="content-type" content="text/html; charset=utf-8" /><title>Homework</title></head><body><pre>' + \
+        html.escape(log, quote=False) + '</pre></body></html>'
+
+
+def accepts_gzip(accept_encoding: str):
+    """
+    accept_encoding:  value of the Accept-Encoding header
+    return:           bool, gzip has a non-zero q-value, explicitly or through *
+    """
+    q = dict()
+    for item in accept_encoding.split(','):
+        coding, *params = [s.strip() for s in item.split(';')]
+        value = 1.0
+        for param in params:
+            if param.replace(' ', '').startswith('q='):
+                try:
+                    value = float(param.split('=', 1)[1])
+                except ValueError:
+                    value = 0.0
+        if coding != '':
+            q[coding.lower()] = value
+    return q.get('gzip', q.get('x-gzip', q.get('*', 0.0))) > 0
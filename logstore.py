@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# Packed log store: every log of an assignment in one append-only file instead of one file per student.
+# Standard library only, the md5log view of web/ reads the store with it.
+#   python logstore.py migrate {PATH}/result/log [--remove]
+#   python logstore.py cat {PATH}/result/log {md5}
+import os
+import gzip
+import mmap
+import struct
+import hashlib
+import argparse
+
+try:
+    import fcntl
+except ImportError:  # not POSIX, a single writer is assumed
+    fcntl = None
+
+from logpage import render_html
+
+# md5 digest, offset of the log in the pack, bytes of the log, bytes of the gzipped page behind it
+RECORD = struct.Struct('<16sQQQ')
+
+
+class LogStore:
+    """
+    {path}.pack holds, for every log, the utf-8 log followed by its published page
+    (logpage.render_html, gzipped), {path}.idx a fixed size RECORD per log.
+    Both files are only appended to, a record is written after its data, so a crash
+    never leaves a record pointing at missing bytes. Readers map the pack with mmap and
+    get memoryview slices of it, and see the logs appended by other processes.
+    """
+
+    def __init__(self, path: str):
+        """
+        path:         result/log, the store is result/log.pack and result/log.idx
+        """
+        self.pack_path = path+'.pack'
+        self.index_path = path+'.idx'
+        self.index = dict()  # md5 -> (offset, log bytes, page bytes)
+        self.index_size = 0
+        self.map = None
+        self.refresh()
+
+    def refresh(self):
+        # read the records appended since the last refresh
+        if not os.path.exists(self.index_path):
+            return
+        size = os.path.getsize(self.index_path)
+        size -= size % RECORD.size  # a record torn by a crash
+        if size > self.index_size:
+            with open(self.index_path, 'rb') as f:
+                f.seek(self.index_size)
+                data = f.read(size-self.index_size)
+            for digest, offset, length, page_length in RECORD.iter_unpack(data):
+                self.index[digest.hex()] = (offset, length, page_length)
+            self.index_size = size
+
+    def __contains__(self, md5: str):
+        if md5 not in self.index:
+            self.refresh()
+        return md5 in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def put(self, log: str):
+        """
+        Append the log and its page if the store does not hold it yet.
+        return:       md5
+        """
+        data = str.encode(log, encoding='utf-8')
+        md5 = hashlib.md5(data).hexdigest()
+        if md5 in self:
+            return md5
+        page = gzip.compress(render_html(log).encode('utf-8'), mtime=0)
+        with open(self.pack_path, 'ab') as pack, open(self.index_path, 'ab') as index:
+            if fcntl is not None:
+                fcntl.flock(index, fcntl.LOCK_EX)
+            # another process may have appended it meanwhile
+            self.refresh()
+            if md5 not in self.index:
+                index.truncate(self.index_size)
+                offset = pack.seek(0, os.SEEK_END)
+                pack.write(data)
+                pack.write(page)
+                pack.flush()
+                os.fsync(pack.fileno())
+                index.write(RECORD.pack(bytes.fromhex(md5),
+                                        offset, len(data), len(page)))
+                index.flush()
+                os.fsync(index.fileno())
+                self.index[md5] = (offset, len(data), len(page))
+                self.index_size += RECORD.size
+        return md5
+
+    def view(self, md5: str, page: bool = False):
+        """
+        page:         the gzipped HTML page instead of the log
+        return:       memoryview of the mapped pack, None if the store has no such log
+        """
+        if md5 not in self:
+            return None
+        offset, length, page_length = self.index[md5]
+        end = offset+length+page_length
+        if self.map is None or len(self.map) < end:
+            # the pack has grown, the old map is closed once its views are released
+            with open(self.pack_path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if page:
+            return memoryview(self.map)[offset+length:end]
+        return memoryview(self.map)[offset:offset+length]
+
+
+def migrate(log_path: str, remove: bool = False):
+    """
+    Append every log file of log_path to the store log_path.pack/.idx.
+    remove:       delete the files, with their published pages, once they are in the store
+    return:       number of migrated logs
+    """
+    store = LogStore(log_path.rstrip('/\\'))
+    names = sorted(name for name in os.listdir(log_path) if len(name) == 32)
+    for name in names:
+        with open(os.path.join(log_path, name), 'rb') as f:
+            md5 = store.put(f.read().decode('utf-8'))
+        assert md5 == name, f'{name}: the content has md5 {md5}'
+    if remove:
+        for name in names:
+            for suffix in ('', '.html', '.html.gz'):
+                if os.path.exists(os.path.join(log_path, name+suffix)):
+                    os.remove(os.path.join(log_path, name+suffix))
+    return len(names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser(
+        'migrate', help='convert a log folder to log.pack and log.idx beside it.')
+    p.add_argument('log_path', type=str, help='result/log folder.')
+    p.add_argument('--remove', action='store_true',
+                   help='delete the migrated files.')
+    p = subparsers.add_parser('cat', help='print a log of a store.')
+    p.add_argument('log_path', type=str, help='result/log, without .pack.')
+    p.add_argument('md5', type=str)
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        print('migrate:', migrate(args.log_path, args.remove), 'logs')
+    else:
+        data = LogStore(args.log_path).view(args.md5)
+        assert data is not None, 'no such log'
+        print(str(data, 'utf-8'))
@@ -6,19 +6,21 @@ import json
 import glob
 import string
 import argparse
-import hashlib
-import pickle
 import multiprocessing
 from typing import List, Tuple, Dict
 import unicodedata
 
 import xlrd
-import xlwt
-import numpy as np
 import cv2
 
 import docxparser
-from match import match
+import mannal
+import similarity
+import fingerprint
+from match import match, ENGINES
+from parsecache import ParseCache
+from spjpool import SPJExecutor
+from report import write_result, open_logs, FORMATS, Statistics
 
 
 def wide_chars(s):
@@ -72,8 +74,87 @@ def shorten_log(s: str, length=20):
     return s
 
 
-wrong_answer_statistics = []  # (userid,taskid,user_input)
-score_statistics = []  # (userid,taskid,score)
+statistics = Statistics()  # wrong answers, scores and answer_cache counters of every task
+# (taskid,normalized user_input) -> (score,log) of automatic tasks, shared by all students
+answer_cache = dict()
+# (taskid,normalized user_input) -> userid, the lookup judged ahead by prefetch_spj, counted there as the miss
+prefetched = dict()
+# spj.py of the working folder defines run_batch, set by load_spj
+has_batch = False
+# arguments of SPJExecutor, None to call spj.run in this process
+spj_options = None
+spj_executor = None
+
+
+def get_spj_executor(processes: int = 1):
+    """
+    return:       the SPJExecutor of this process, None if spj runs inline
+    """
+    global spj_executor
+    if spj_options is None:
+        return None
+    if spj_executor is None or spj_executor.pid != os.getpid():
+        # a forked worker must not share the judge processes of its parent
+        spj_executor = SPJExecutor(processes=processes, **spj_options)
+    return spj_executor
+
+
+def new_statistics():
+    # statistics of a worker process, merged by the main process with merge_statistics
+    return Statistics()
+
+
+def merge_statistics(stats: Statistics):
+    statistics.merge(stats)
+
+
+class AnswerMatcher:
+    """
+    Answer specification of a task compiled once: a str (full score), a
+    {'answer','score'} dict, or a list of them where the first matching entry
+    with a positive score wins. Exact answers are a dict lookup, REGEX answers
+    are precompiled and must match the whole text.
+    """
+
+    def __init__(self, answer, score: float, isregex: bool = False):
+        self.isregex = isregex
+        self.exact = dict()   # answer text -> score
+        self.patterns = []    # List[Tuple[compiled regex, score]]
+        # in a list, entries without a positive score never win
+        only_positive = type(answer) == list
+        for item, item_score in self.flatten(answer, score):
+            if only_positive and not item_score > 0.0:
+                continue
+            if isregex:
+                self.patterns.append((re.compile(item), item_score))
+            else:
+                self.exact.setdefault(item, item_score)
+
+    @staticmethod
+    def flatten(answer, score: float):
+        # yield (answer, score) in the order they are checked
+        if type(answer) == str:
+            yield answer, score
+        elif type(answer) == dict and type(answer.get('answer')) == str and 'score' in answer:
+            yield answer['answer'], answer['score']
+        elif type(answer) == list:
+            for item in answer:
+                yield from AnswerMatcher.flatten(item, score)
+        else:
+            raise ValueError(
+                f'answer {answer!r} of type {type(answer).__name__}, expected str, {{"answer","score"}} or a list of them')
+
+    def score(self, text: str):
+        """
+        text:         normalized user's answer
+        return:       score of the first matching answer, 0.0 if none matches
+        """
+        if self.isregex:
+            for pattern, score in self.patterns:
+                if pattern.fullmatch(text):
+                    return score
+            return 0.0
+        return self.exact.get(text, 0.0)
 
 
 class Task:
@@ -92,6 +173,14 @@ class Task:
             raise NotImplementedError
         assert(hasattr(self, 'taskid'))
         assert(hasattr(self, 'score') and type(self.score) == float)
+        # the answer of PROGRAM and MANNAL tasks is reference data of the spj or the grader
+        self.matcher = None
+        if not self.isprogram and not self.ismannal:
+            try:
+                self.matcher = AnswerMatcher(
+                    self.answer, self.score, self.isregex)
+            except ValueError as e:
+                raise ValueError(f'Task {self.taskid}: {e}') from None
 
     def parseArgs(self, args):
         self.isregex = 'REGEX' in args          # 是否开启正则匹配模式
@@ -101,9 +190,14 @@ class Task:
         self.isjump = 'JUMP' in args            # 是否是子问题（主问题满分自动跳过）
         self.islowercase = 'LOWERCASE' in args
         self.isprogram = 'PROGRAM' in args
+        self.isnocache = 'NOCACHE' in args      # 不缓存相同答案的阅卷结果（如结果不确定的spj）
         if self.isjump:
             self.jumpTarget = args[1+args.index('JUMP')]
 
+    def normalize(self, text: str):
+        # user's answer as it is matched and cached
+        return text.lower() if self.islowercase else text
+
     def fromSettings(self, settings):
         assert('tasks' in settings)
         assert(self.taskid in settings['tasks'])
@@ -112,112 +206,129 @@ class Task:
         self.answer = setting.get('answer', '')
         self.parseArgs(setting.get('args', []))
 
-    def run(self, userfile: str, userid: str, result_path: str, text: str, imgs: List[np.ndarray], user_input: List, tasks: List) -> Tuple[Dict]:
+    def run(self, userfile: str, userid: str, result_path: str, text: str, imgs: List[docxparser.LazyImage], user_input: List, tasks: List,
+            stats: Statistics = None, defer_mannal: bool = False) -> Tuple[Dict]:
         """
+        stats:        statistics to update, the module global by default
+        defer_mannal: do not prompt for uncached MANNAL tasks, return {'pending':taskid} instead
         return {'score':float,'log':str}
         """
+        if stats is None:
+            stats = statistics
         origin_text = text
         result = dict()
         self.userid = userid
 
         def gen_result_line(score: float, log: str = None):
-            log_text = shorten_log(repr(origin_text))
-            if score == self.score:
-                result_symbol = '√'+f'  +{self.score}'
-            elif score > 0:
-                result_symbol = '×'+f'  +{score}'
-            else:
-                result_symbol = '×'
-            ret = dict()
-            ret['score'] = score
-            ret['log'] = f'Task:{self.taskid}\tYour_Answer:{log_text}\t{result_symbol}'
-            if log != None:
-                assert(type(log) == str)
-                ret['log'] += '\n    '.join(['']+log.split('\n'))
-            return ret
+            return self.result_line(origin_text, score, log)
         if self.ismannal:
             # 人工阅卷
             task_key = userid+'-'+self.taskid
-            cache_path = os.path.join(result_path, 'mannal.json')
-            cache = json.load(open(cache_path, 'r')) if os.path.exists(
-                cache_path) else {}
+            cache = mannal.open_cache(result_path)
             if task_key in cache:
                 result = cache[task_key]
+            elif defer_mannal:
+                return {'score': 0.0, 'log': '', 'pending': self.taskid}
             else:
-                print('-'*40+'\n'+userid +
-                      f'\nTask:{self.taskid} ({self.score})\n')
-                print(text)
-                if len(imgs) > 0:
-                    for i in range(len(imgs)):
-                        cv2.imshow('img'+str(i), imgs[i])
-                    cv2.waitKey(10)
-                while True:
-                    score = input(
-                        'Input score (press "O" to open the docx file):')
-                    if score.lower() == 'o':
-                        command = self.settings.get(
-                            'openFileCommand').replace('{path}', os.path.abspath(userfile))
-                        os.system(command)
-                        continue
-                    if re.match(r'^\d+(\.\d+)?$', score):
-                        score = float(score)
-                        if score > self.score:
-                            print('  Too much score!')
-                        else:
-                            break
-                    else:
-                        print('  Format error!')
+                score = self.ask_score(userfile, userid, text, imgs)
                 result = gen_result_line(score)
-                if len(imgs) > 0:
-                    cv2.destroyAllWindows()
                 cache[task_key] = result
-                json.dump(cache, open(cache_path, 'w'))
         else:
             # 自动阅卷
-            if self.islowercase:
-                text = text.lower()
+            text = self.normalize(text)
+            # identical text-only answers are judged once
+            cacheable = not self.isnocache and len(imgs) == 0
+            cache_key = (self.taskid, text)
+            if cacheable and cache_key in answer_cache:
+                score, log = answer_cache[cache_key]
+                if prefetched.get(cache_key) != userid:
+                    stats.add_cache(self.taskid, True)
             # 程序阅卷
-            if self.isprogram:
-                spj_result = spj.run(self.taskid, input=text, task=self)
+            elif self.isprogram:
+                executor = get_spj_executor()
+                if executor is not None:
+                    spj_result = executor.run(self.taskid, text, self)
+                else:
+                    spj_result = spj.run(self.taskid, input=text, task=self)
                 score = spj_result['score']
                 log = spj_result.get('log', None) or None
-                result = gen_result_line(score, log)
             else:
                 # 匹配阅卷
-                def match(answer, text):
-                    if self.isregex:
-                        return bool(re.match('^'+answer+'$', text))
-                    else:
-                        return answer == text
-
-                def check(item, text):
-                    # return score
-                    if type(item) == str:
-                        return self.score if match(item, text) else 0.0
-                    elif type(item) == dict:
-                        return item['score'] if match(item['answer'], text) else 0.0
-                    elif type(item) == list:
-                        for answer in item:
-                            r = check(answer, text)
-                            if r > 0.0:
-                                return r
-                        return 0.0
-                    else:
-                        raise NotImplementedError
-                score = check(self.answer, text)
-                result = gen_result_line(score)
+                score = self.matcher.score(text)
+                log = None
+            if cacheable and cache_key not in answer_cache:
+                answer_cache[cache_key] = (score, log)
+                stats.add_cache(self.taskid, False)
+            result = gen_result_line(score, log)
         assert('score' in result and 'log' in result)
         if result['score'] < self.score:
-            wrong_answer_statistics.append((userid, self.taskid, origin_text))
-        score_statistics.append((userid, self.taskid, result['score']))
+            stats.add_wrong(userid, self.taskid, origin_text)
+        stats.add_score(userid, self.taskid, result['score'])
         if self.isjump and result['score'] < self.score:
             for i, task in enumerate(tasks):
                 if task.taskid == self.jumpTarget:
                     print(result['log'], '. JUMP to : {{task.taskid}}.')
                     text, imgs = user_input[i]
-                    return task.run(userfile, userid, result_path, text, imgs, user_input, tasks)
+                    return task.run(userfile, userid, result_path, text, imgs, user_input, tasks, stats, defer_mannal)
         return result
 
+    def result_line(self, text: str, score: float, log: str = None):
+        """
+        text:         user's answer as aligned, before normalization
+        return:       {'score':float,'log':str}
+        """
+        log_text = shorten_log(repr(text))
+        if score == self.score:
+            result_symbol = '√'+f'  +{self.score}'
+        elif score > 0:
+            result_symbol = '×'+f'  +{score}'
+        else:
+            result_symbol = '×'
+        ret = dict()
+        ret['score'] = score
+        ret['log'] = f'Task:{self.taskid}\tYour_Answer:{log_text}\t{result_symbol}'
+        if log != None:
+            assert(type(log) == str)
+            ret['log'] += '\n    '.join(['']+log.split('\n'))
+        return ret
+
+    def render(self, title: str, text: str):
+        # the console text of ask_score
+        return '-'*40+'\n'+title + f'\nTask:{self.taskid} ({self.score})\n\n' + text
+
+    def ask_score(self, userfile: str, title: str, text: str, imgs: List[docxparser.LazyImage], rendered: str = None):
+        """
+        Show the answer on the console and its images in windows, read the score typed by the grader.
+        title:        first line shown, usually the userid
+        rendered:     render(title, text) if prepared ahead
+        """
+        print(rendered if rendered is not None else self.render(title, text))
+        if len(imgs) > 0:
+            for i in range(len(imgs)):
+                img = imgs[i].load()
+                if img is not None:
+                    cv2.imshow('img'+str(i), img)
+            cv2.waitKey(10)
+        while True:
+            score = input(
+                'Input score (press "O" to open the docx file):')
+            if score.lower() == 'o':
+                command = self.settings.get(
+                    'openFileCommand').replace('{path}', os.path.abspath(userfile))
+                os.system(command)
+                continue
+            if re.match(r'^\d+(\.\d+)?$', score):
+                score = float(score)
+                if score > self.score:
+                    print('  Too much score!')
+                else:
+                    break
+            else:
+                print('  Format error!')
+        if len(imgs) > 0:
+            cv2.destroyAllWindows()
+        return score
+
     def __str__(self):
         s = f'{self.taskid}:\t'
         s += 'MANNAL' if self.ismannal else 'AUTO'
@@ -233,6 +344,8 @@ class Task:
             s += ' NOCOMMENT'
         if self.isprogram:
             s += ' PROGRAM'
+        if self.isnocache:
+            s += ' NOCACHE'
         s += '\tScore:'+str(self.score)
         s += '\tAnswer:'+str(self.answer)
         return s
@@ -260,11 +373,59 @@ def parseAnswer(answer: str, settings: Dict):
     return tasks
 
 
-def parse(user_file: str, answer: str):
+def split_template(answer: str):
+    """
+    answer:       text of answer.docx
+    return:       (template text without task markers, end address of the text before each task)
+    """
+    # find all task
+    split_pattern = r'\$:>.*?<:\$'
+    template_str = ''
+    task_address = []
+    for s in re.split(split_pattern, answer):
+        template_str += s
+        task_address.append(len(template_str))
+    task_address.pop()
+    return template_str, task_address
+
+
+def split_pair(pair: List[Tuple[str, str]], task_address: List[int]):
+    """
+    pair:         alignment of user's text against the template text
+    return:       List[str], the user's text aligned to each task position
+    """
+    addr_mapping = dict()
+    for now_addr in range(len(pair)):
+        a, b = pair[now_addr]
+        if b:
+            addr_mapping[len(addr_mapping)] = now_addr
+    addr_mapping[len(addr_mapping)] = len(pair)
+    texts = []
+    for i in task_address:
+        L = pair[addr_mapping[i-1]+1:addr_mapping[i]]
+        texts.append((''.join(a for a, b in L)).strip())
+    return texts
+
+
+def relocate(user_answer: List[Tuple[str, List[docxparser.LazyImage]]], user_file: str):
+    """
+    Point the image handles of a cached step 1 result to user_file,
+    the same docx bytes may have been parsed under another name.
+    """
+    for text, imgs in user_answer:
+        for img in imgs:
+            if img.data is None:
+                img.docx = user_file
+    return user_answer
+
+
+def parse(user_file: str, answer: str, engine: str = 'dp', band: int = 256, anchor: bool = False):
     """
     user_file:    user's docx filepath
     answer:       text of answer.docx
-    return:       List[Tuple[user_answer:str,List[cv2::imgs]]]
+    engine, band: alignment engine, see match.align
+    anchor:       only align the gaps between exact-match anchors, see match.find_anchors
+    return:       List[Tuple[user_answer:str,List[docxparser.LazyImage]]]
     """
     file = os.path.basename(user_file)
     suffix = os.path.splitext(file)[-1]  # .docx
@@ -275,15 +436,7 @@ def parse(user_file: str, answer: str):
         score = 0.0
         return {'score': score, 'log': log}
 
-    # find all task
-    split_pattern = r'\$:>.*?<:\$'
-    # parse user's answer
-    template_str = ''
-    task_address = []
-    for s in re.split(split_pattern, answer):
-        template_str += s
-        task_address.append(len(template_str))
-    task_address.pop()
+    template_str, task_address = split_template(answer)
     L = user_input.split(docxparser.graphic_token)
     if len(L) != len(user_imgs)+1:
         print(f'Warning. {user_file} image number mismatch. imgs:' +
@@ -293,17 +446,10 @@ def parse(user_file: str, answer: str):
         user_input += L[i]
         if i < len(user_imgs):
             user_input += f'<docximg:{i}>'
-    pair = match(user_input, template_str)
-    addr_mapping = dict()
-    for now_addr in range(len(pair)):
-        a, b = pair[now_addr]
-        if b:
-            addr_mapping[len(addr_mapping)] = now_addr
-    addr_mapping[len(addr_mapping)] = len(pair)
+    pair = match(user_input, template_str,
+                 engine=engine, band=band, anchor=anchor)
     user_answer = []
-    for i in task_address:
-        L = pair[addr_mapping[i-1]+1:addr_mapping[i]]
-        text = (''.join(a for a, b in L)).strip()
+    for text in split_pair(pair, task_address):
         imgs = [user_imgs[int(i)]
                 for i in re.findall(r'<docximg:(\d+)>', text)]
         text = re.sub(r'<docximg:(\d+)>', '{img}', text)
@@ -312,7 +458,67 @@ def parse(user_file: str, answer: str):
     return user_answer
 
 
-def scoring(userfile: str, userid: str, result_path: str, user_input: Tuple[str, List[np.ndarray]], tasks: List[Task]):
+def run_tasks(userfile: str, userid: str, result_path: str, user_input: Tuple[str, List[docxparser.LazyImage]], tasks: List[Task],
+              stats: Statistics = None, defer_mannal: bool = False):
+    """
+    return:       List[Dict:{'score':float,'log':str}], one for each task which is not SUB
+    """
+    results = []
+    for (text, imgs), task in zip(user_input, tasks):
+        if not task.issub:
+            results.append(task.run(userfile, userid, result_path, text,
+                                    imgs, user_input, tasks, stats, defer_mannal))
+    return results
+
+
+def resolve_pending(userfile: str, userid: str, result_path: str, user_input: Tuple[str, List[docxparser.LazyImage]], tasks: List[Task],
+                    results: List[Dict]):
+    """
+    Grade the MANNAL tasks deferred by run_tasks in this process.
+    """
+    for k in range(len(results)):
+        if 'pending' in results[k]:
+            i = [task.taskid for task in tasks].index(results[k]['pending'])
+            text, imgs = user_input[i]
+            results[k] = tasks[i].run(userfile, userid, result_path, text,
+                                      imgs, user_input, tasks)
+    return results
+
+
+def prefetch_mannal(userid: str, result_path: str, user_input: Tuple[str, List[docxparser.LazyImage]], tasks: List[Task]):
+    # decode the images of the MANNAL tasks of a submission which are not graded yet
+    cache = mannal.open_cache(result_path)
+    for (text, imgs), task in zip(user_input, tasks):
+        if task.ismannal and userid+'-'+task.taskid not in cache:
+            mannal.load_images(imgs)
+
+
+def release_mannal(user_input: Tuple[str, List[docxparser.LazyImage]]):
+    for text, imgs in user_input:
+        mannal.release_images(imgs)
+
+
+def task_answers(user_input: Tuple[str, List[docxparser.LazyImage]], tasks: List[Task]):
+    # (taskid, user's answer) of every task which is not SUB
+    return [(task.taskid, text) for (text, imgs), task in zip(user_input, tasks) if not task.issub]
+
+
+def pending_mannal(userfile: str, userid: str, user_input: Tuple[str, List[docxparser.LazyImage]], tasks: List[Task],
+                   results: List[Dict]):
+    """
+    return:       List[Tuple[userfile,userid,Task,text,imgs]] of the MANNAL tasks deferred in results
+    """
+    taskD = {task.taskid: i for i, task in enumerate(tasks)}
+    items = []
+    for r in results:
+        if 'pending' in r:
+            i = taskD[r['pending']]
+            text, imgs = user_input[i]
+            items.append((userfile, userid, tasks[i], text, imgs))
+    return items
+
+
+def summarize(userfile: str, userid: str, results: List[Dict]):
     """
     return:       Dict:{'score':float,'log':str}
     """
@@ -321,12 +527,9 @@ def scoring(userfile: str, userid: str, result_path: str, user_input: Tuple[str,
     sum_score = 0.0
     log = os.path.basename(userfile)+'\n'
     log += 'This report is generated by the automatic marking program\n'
-    for (text, imgs), task in zip(user_input, tasks):
-        if not task.issub:
-            result = task.run(userfile, userid, result_path, text,
-                              imgs, user_input, tasks)
-            log += '  '+result['log']+'\n'
-            sum_score += result['score']
+    for result in results:
+        log += '  '+result['log']+'\n'
+        sum_score += result['score']
     log += f'Total Score: {sum_score}\n'
     log = format_log(log)
     print(userid, sum_score)
@@ -334,8 +537,103 @@ def scoring(userfile: str, userid: str, result_path: str, user_input: Tuple[str,
     return {'score': sum_score, 'log': log}
 
 
+def scoring(userfile: str, userid: str, result_path: str, user_input: Tuple[str, List[docxparser.LazyImage]], tasks: List[Task]):
+    """
+    return:       Dict:{'score':float,'log':str}
+    """
+    return summarize(userfile, userid, run_tasks(userfile, userid, result_path, user_input, tasks))
+
+
+def scoring_worker(userfile: str, userid: str, result_path: str, user_input: Tuple[str, List[docxparser.LazyImage]], tasks: List[Task]):
+    """
+    Automatic part of scoring() for a worker process, MANNAL tasks are deferred.
+    return:       (results of run_tasks, statistics)
+    """
+    stats = new_statistics()
+    results = run_tasks(userfile, userid, result_path,
+                        user_input, tasks, stats, defer_mannal=True)
+    return results, stats
+
+
+def stream_worker(job: Tuple):
+    """
+    Parse, align and score one submission as soon as a worker is free.
+    job:          (index, userfile, userid, answer, result_path, tasks, step1_cache, parse options)
+    return:       (index, cache key, step 1 result, results of run_tasks, statistics)
+                  step 1 result is only sent back on parse error or with deferred MANNAL tasks
+    """
+    i, userfile, userid, answer, result_path, tasks, step1_cache, options = job
+    key = step1_cache.key(userfile)
+    data = step1_cache.load(key)
+    if data is not None:
+        relocate(data, userfile)
+    else:
+        data = parse(userfile, answer, *options)
+        if type(data) == dict and 'score' in data:
+            return i, key, data, None, None
+        step1_cache.save(key, data)
+    results, stats = scoring_worker(
+        userfile, userid, result_path, data, tasks)
+    if not any('pending' in r for r in results):
+        data = None
+    return i, key, data, results, stats
+
+
+def prefetch_spj(step1_result: List, userids: List[str], tasks: List[Task], executor: SPJExecutor = None):
+    """
+    Judge every distinct text-only answer of the cached PROGRAM tasks across
+    all submissions, in one batch by the executor or by one spj.run_batch call
+    per task. The results are put in answer_cache, every judged answer is
+    counted as the miss of the first student who gave it.
+    return:       number of judged answers
+    """
+    inputs = dict()  # taskid -> List[normalized user_input]
+    for data, userid in zip(step1_result, userids):
+        if type(data) == dict and 'score' in data:
+            continue
+        for (text, imgs), task in zip(data, tasks):
+            if task.isprogram and not (task.ismannal or task.issub or task.isnocache) and len(imgs) == 0:
+                key = (task.taskid, task.normalize(text))
+                if key not in answer_cache:
+                    answer_cache[key] = None
+                    prefetched[key] = userid
+                    inputs.setdefault(task.taskid, []).append(key[1])
+    taskD = {task.taskid: task for task in tasks}
+    if executor is not None:
+        calls = [(taskid, text) for taskid, L in inputs.items() for text in L]
+        results = executor.run_batch(calls, taskD)
+    else:
+        calls, results = [], []
+        for taskid, L in inputs.items():
+            calls += [(taskid, text) for text in L]
+            try:
+                batch = spj.run_batch(taskid, L, taskD[taskid])
+                assert(len(batch) == len(L))
+            except Exception as e:
+                # the same results as Task.run would get, one call at a time
+                print('Special judge: run_batch of task', taskid, 'failed:', repr(e))
+                batch = [spj.run(taskid, input=text, task=taskD[taskid]) for text in L]
+            results += batch
+    for key, spj_result in zip(calls, results):
+        answer_cache[key] = (spj_result['score'],
+                             spj_result.get('log', None) or None)
+        statistics.add_cache(key[0], False)
+    return len(calls)
+
+
+def init_worker(root: str, options: Dict, cache: Dict, judged: Dict = None):
+    # initializer of the pool workers of step 2
+    global spj_options
+    load_spj(root)
+    spj_options = options
+    answer_cache.update(cache)
+    prefetched.update(judged or dict())
+
+
 def load_spj(work_dir: str):
     # load special judge program
+    global has_batch
+    has_batch = False
     path = os.path.join(work_dir, 'program/spj.py')
     if os.path.exists(path) and 'spj' not in sys.modules:
         import importlib.util
@@ -344,6 +642,25 @@ def load_spj(work_dir: str):
         spj = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(spj)
         assert(callable(spj.run))
+        # optional: run_batch(taskid, inputs: List[str], task) -> List[Dict]
+        has_batch = hasattr(spj, 'run_batch')
+        if has_batch:
+            assert(callable(spj.run_batch))
+
+
+def load_workdir(root: str):
+    """
+    Parse answer.docx and settings.json of a working folder.
+    return:       (text of answer.docx, settings, List[Task])
+    """
+    answer_path = os.path.join(root, 'answer.docx')
+    settings_path = os.path.join(root, 'settings.json')
+    assert(os.path.exists(answer_path))
+    assert(os.path.exists(settings_path))
+    answer, answer_imgs = docxparser.process(answer_path)
+    settings = json.load(open(settings_path, 'r', encoding="utf-8"))
+    tasks = parseAnswer(answer, settings)
+    return answer, settings, tasks
 
 
 if __name__ == "__main__":
@@ -351,23 +668,49 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-w', '--workdir', type=str,
                         required=True, help='working folder path.')
+    parser.add_argument('-e', '--engine', type=str, default='dp', choices=ENGINES,
+                        help='sequence alignment engine of step 1.')
+    parser.add_argument('--band', type=int, default=256,
+                        help='half width of the diagonal band for the banded engine.')
+    parser.add_argument('--anchor', action='store_true',
+                        help='align only the gaps between exact-match anchors.')
+    parser.add_argument('-j', '--jobs', type=int, default=0,
+                        help='worker processes of step 2, MANNAL tasks are graded afterwards (0: serial).')
+    parser.add_argument('--stream', action='store_true',
+                        help='parse, align and score every submission as soon as it is ready (-j workers, 16 by default).')
+    parser.add_argument('-o', '--output', type=str, nargs='+', default=['xls'], choices=FORMATS,
+                        help='formats of the result table, result.xls by default.')
+    parser.add_argument('--pack', action='store_true',
+                        help='write the logs to the packed store result/log.pack instead of result/log/{md5} files.')
+    parser.add_argument('--similarity', type=float, nargs='?', const=0.8, default=None,
+                        help='report pairs of submissions whose answers have at least this aligned similarity (0.8) to result/similarity.txt.')
+    parser.add_argument('--images', type=int, nargs='?', const=6, default=None,
+                        help='report images of different students within this dHash distance (6) to result/images.txt.')
+    parser.add_argument('--prefetch', type=int, default=4,
+                        help='MANNAL items whose images are decoded ahead in background threads (0: off).')
+    parser.add_argument('--group-mannal', action='store_true',
+                        help='grade MANNAL tasks before step 2, task by task, each distinct answer once.')
+    parser.add_argument('--spj-timeout', type=float, default=0,
+                        help='run spj in separate processes with this time limit per call in seconds (0: inline, no limit).')
+    parser.add_argument('--spj-memory', type=int, default=0,
+                        help='memory limit in MB of every spj process (0: no limit).')
+    parser.add_argument('--spj-jobs', type=int, default=4,
+                        help='spj processes of the main process.')
     args = parser.parse_args()
     # pre-work
     root = os.path.abspath(args.workdir)
     data_path = os.path.join(root, 'data')
     xls_path = os.path.join(root, 'template.xls')
-    answer_path = os.path.join(root, 'answer.docx')
     result_path = os.path.join(root, 'result')
-    settings_path = os.path.join(root, 'settings.json')
     assert(os.path.exists(root))
     assert(os.path.exists(data_path))
     assert(os.path.exists(xls_path))
-    assert(os.path.exists(answer_path))
-    assert(os.path.exists(settings_path))
     load_spj(root)
-    answer, answer_imgs = docxparser.process(answer_path)
-    settings = json.load(open(settings_path, 'r', encoding="utf-8"))
-    tasks = parseAnswer(answer, settings)
+    answer, settings, tasks = load_workdir(root)
+    spj_path = os.path.join(root, 'program/spj.py')
+    if args.spj_timeout > 0 and os.path.exists(spj_path):
+        spj_options = {'path': spj_path, 'timeout': args.spj_timeout,
+                       'memory': args.spj_memory, 'batch': has_batch}
     print(format_log('Tasks:\n'+'\n'.join('  '+str(t) for t in tasks)))
     user_files = glob.glob(os.path.join(data_path, '*.*'))
     workbook = xlrd.open_workbook(xls_path)
@@ -388,88 +731,166 @@ if __name__ == "__main__":
     if hasIllegalFile:
         print('Has illegal file, mandatory termination.')
         quit()
-    log_path = os.path.join(result_path, 'log')
     begin = input('Press Y to be continue: ')
     if begin.lower() == 'y':
         create_folder(result_path)
-        create_folder(log_path)
-        result = []  # Store the final result: [{'score':float,'log':str},...]
-        # Step 1: Parse user document and get the content of each task
-        print('Step 1: Sequence Alignment')
-        step1_cache = os.path.join(result_path, 'parse.cache')
-        if os.path.exists(step1_cache):
-            step1_result = pickle.load(open(step1_cache, 'rb'))
+        logs = open_logs(result_path, args.pack)
+        # Store the final result: [{'score':float,'log':str} or {'score':float,'md5':str},...]
+        result = []
+        userids = [os.path.splitext(os.path.basename(s))[0]
+                   for s in user_files]
+        step1_cache = ParseCache(os.path.join(result_path, 'parse_cache'),
+                                 answer, (args.engine, args.band, args.anchor))
+        if args.stream:
+            # Step 1 and 2 in one pipeline, logs are written as soon as a submission is scored
+            print('Step 1+2: Sequence Alignment and Scoring')
+            result = [None]*len(user_files)
+            step1_keys = [None]*len(user_files)
+            pending = []
+            jobs = [(i, user_files[i], userids[i], answer, result_path, tasks, step1_cache,
+                     (args.engine, args.band, args.anchor)) for i in range(len(user_files))]
+            with multiprocessing.Pool(args.jobs or 16, initializer=init_worker, initargs=(root, spj_options, answer_cache)) as p:
+                for i, key, data, results, stats in p.imap_unordered(stream_worker, jobs):
+                    step1_keys[i] = key
+                    if results is None:
+                        # parse user.docx error, record directly.
+                        result[i] = data
+                        continue
+                    merge_statistics(stats)
+                    if data is not None:
+                        pending.append((i, data, results))
+                        continue
+                    D = summarize(user_files[i], userids[i], results)
+                    result[i] = {'score': D['score'],
+                                 'md5': logs.put(D['log'])}
+            print('Stream over,', len(pending),
+                  'files wait for MANNAL scoring.')
+            if args.group_mannal:
+                mannal.grade_groups([item for i, data, results in pending for item in pending_mannal(
+                    user_files[i], userids[i], data, tasks, results)], result_path, args.prefetch)
+            with mannal.Prefetcher(pending, lambda p: prefetch_mannal(userids[p[0]], result_path, p[1], tasks),
+                                   args.prefetch) as prefetcher:
+                for k, (i, data, results) in enumerate(pending):
+                    prefetcher.get(k)
+                    results = resolve_pending(
+                        user_files[i], userids[i], result_path, data, tasks, results)
+                    release_mannal(data)
+                    D = summarize(user_files[i], userids[i], results)
+                    result[i] = {'score': D['score'],
+                                 'md5': logs.put(D['log'])}
+            step1_cache.evict(step1_keys)
         else:
-            with multiprocessing.Pool(16) as p:
-                step1_result = p.starmap(parse, [(user_files[i], answer)
-                                                 for i in range(len(user_files))])
+            # Step 1: Parse user document and get the content of each task
+            print('Step 1: Sequence Alignment')
+            step1_keys = [step1_cache.key(s) for s in user_files]
+            step1_result = [step1_cache.load(k) for k in step1_keys]
+            for i in range(len(user_files)):
+                if step1_result[i] is not None:
+                    relocate(step1_result[i], user_files[i])
+            todo = [i for i in range(len(user_files)) if step1_result[i] is None]
+            print('Step1 cache:', len(user_files)-len(todo), 'hit,',
+                  len(todo), 'to be aligned.')
+            if len(todo) > 0:
+                with multiprocessing.Pool(min(16, len(todo))) as p:
+                    aligned = p.starmap(parse, [(user_files[i], answer, args.engine, args.band, args.anchor)
+                                                for i in todo])
+                for i, r in zip(todo, aligned):
+                    step1_result[i] = r
+                    # parse errors are cheap to reproduce and their log contains the file name
+                    if not (type(r) == dict and 'score' in r):
+                        step1_cache.save(step1_keys[i], r)
             assert(all(len(r) == len(tasks) or (type(r) == dict and 'score' in r)
                        for r in step1_result))
-            pickle.dump(step1_result, open(step1_cache, 'wb'))
-        print('Step1 over,', len(step1_result), 'files are aligned.')
-
-        # Step 2: Scoring
-        for i in range(len(step1_result)):
-            data = step1_result[i]
-            if type(data) == dict and 'score' in data:
-                # parse user.docx error, record directly.
-                result.append(data)
-            else:
-                userid = os.path.splitext(os.path.basename(user_files[i]))[0]
-                print('='*5, 'Scoring:', userid,
-                      f'{i}/{len(step1_result)}', '='*5)
-                result.append(
-                    scoring(user_files[i], userid, result_path, data, tasks))
-
+            step1_cache.evict(step1_keys)
+            print('Step1 over,', len(step1_result), 'files are aligned.')
+
+            # Step 2: Scoring
+            if get_spj_executor(args.spj_jobs) is not None or has_batch:
+                print('Special judge:', prefetch_spj(step1_result, userids, tasks, spj_executor),
+                      'distinct answers are judged.')
+            scored = dict()  # index -> (results of run_tasks with MANNAL deferred, statistics)
+            if args.jobs > 0:
+                jobs = [i for i in range(len(step1_result))
+                        if not (type(step1_result[i]) == dict and 'score' in step1_result[i])]
+                with multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(root, spj_options, answer_cache, prefetched)) as p:
+                    scored = p.starmap(scoring_worker, [(user_files[i], userids[i], result_path, step1_result[i], tasks)
+                                                        for i in jobs])
+                scored = dict(zip(jobs, scored))
+            if args.group_mannal:
+                items = []
+                for i in range(len(step1_result)):
+                    data = step1_result[i]
+                    if not (type(data) == dict and 'score' in data):
+                        # the workers have deferred the MANNAL tasks already, without -j
+                        # the automatic tasks are scored here once, as a worker would
+                        if i not in scored:
+                            scored[i] = scoring_worker(
+                                user_files[i], userids[i], result_path, data, tasks)
+                        items += pending_mannal(user_files[i],
+                                                userids[i], data, tasks, scored[i][0])
+                mannal.grade_groups(items, result_path, args.prefetch)
+            # the images of the next submissions are decoded while the grader scores this one
+            mannal.open_cache(result_path)
+            prefetcher = mannal.Prefetcher([(userids[i], step1_result[i]) for i in range(len(step1_result))
+                                            if type(step1_result[i]) == list],
+                                           lambda p: prefetch_mannal(p[0], result_path, p[1], tasks), args.prefetch)
+            k = 0
+            for i in range(len(step1_result)):
+                data = step1_result[i]
+                if type(data) == list:
+                    prefetcher.get(k)
+                    k += 1
+                if type(data) == dict and 'score' in data:
+                    # parse user.docx error, record directly.
+                    result.append(data)
+                elif i in scored:
+                    results, stats = scored[i]
+                    merge_statistics(stats)
+                    results = resolve_pending(
+                        user_files[i], userids[i], result_path, data, tasks, results)
+                    result.append(summarize(user_files[i], userids[i], results))
+                else:
+                    userid = userids[i]
+                    print('='*5, 'Scoring:', userid,
+                          f'{i}/{len(step1_result)}', '='*5)
+                    result.append(
+                        scoring(user_files[i], userid, result_path, data, tasks))
+                if type(data) == list:
+                    release_mannal(data)
+            prefetcher.close()
+
+        if spj_executor is not None:
+            spj_executor.close()
+        mannal.close_all()
         # write result to result.xls
-        rsheet = workbook.sheet_by_index(0)
-        wbk = xlwt.Workbook()
-        wsheet = wbk.add_sheet(rsheet.name, cell_overwrite_ok=True)
-        for i in range(rsheet.nrows):
-            for j in range(rsheet.ncols):
-                wsheet.write(i, j, rsheet.cell(i, j).value)
-        for i in range(rsheet.nrows):
-            id = rsheet.cell(i, 1).value
-            if id in studentID:
-                D = result[studentID.index(id)]
-                wsheet.write(i, 4, D['score'])
-                # Since the log is usually very large, the log will be written to the file
-                m = hashlib.md5()
-                m.update(str.encode(D['log']))
-                md5 = m.hexdigest()
-                with open(os.path.join(log_path, md5), 'wb') as w:
-                    w.write(str.encode(D['log'], encoding='utf-8'))
-                wsheet.write(
-                    i, 5, settings.get('longTermLog', '').replace('{md5}', md5))
-        wbk.save(os.path.join(result_path, 'result.xls'))
+        write_result(result_path, logs, workbook.sheet_by_index(0), studentID, result,
+                     settings.get('longTermLog', ''), args.output)
         # statistics
-        w = open(os.path.join(result_path, 'statistics.txt'), 'w')
-        w.write('Average Score:'+str(sum(score for uid, tid,
-                                         score in score_statistics)/len(user_files))+'\n')
-        wrong_list = []
-        for task in tasks:
-            L = [(uid, text) for uid, tid,
-                 text in wrong_answer_statistics if tid == task.taskid]
-            D = dict()
-            for uid, text in L:
-                studentID = os.path.basename(uid).split('_')[0]
-                if text not in D:
-                    D[text] = []
-                D[text].append(studentID)
-            L = [(k, v) for k, v in D.items()]
-            L = sorted(L, key=lambda x: -len(x[1]))
-            wrong_list.append(L)
-        w.write('Wrong Case:\n')
-        for i in range(len(tasks)):
-            if len(wrong_list[i]) > 0:
-                w.write('  Task:'+str(tasks[i].taskid)+'\n')
-                for text, userids in wrong_list[i]:
-                    w.write(f"    {repr(text)}:\t"+str(len(userids))+'\n')
-        w.write('Details Wrong Case:\n')
-        w.write('Wrong Case:\n')
-        for i in range(len(tasks)):
-            if len(wrong_list[i]) > 0:
-                w.write('  Task:'+str(tasks[i].taskid)+'\n')
-                for text, userids in wrong_list[i]:
-                    w.write(f"    {repr(text)}:\t"+str(userids)+'\n')
-        w.close()
+        statistics.write(result_path, tasks, len(user_files))
+        if args.similarity is not None:
+            # --stream does not keep the step 1 results, they are in the step 1 cache
+            submissions = dict()
+            for i in range(len(user_files)):
+                data = step1_cache.load(
+                    step1_keys[i]) if args.stream else step1_result[i]
+                if type(data) == list:
+                    submissions[userids[i]] = task_answers(data, tasks)
+            similar = similarity.find_similar(submissions, args.similarity,
+                                              engine=args.engine, band=args.band)
+            similarity.write_report(
+                result_path, similar, len(submissions), args.similarity)
+            print('Similarity:', len(similar), 'pairs of similar submissions.')
+        if args.images is not None:
+            # hashes of answer.docx last, its images are given to every student
+            imghash = fingerprint.HashCache(
+                os.path.join(result_path, 'imghash.json'))
+            hashes = imghash.hashes(
+                user_files+[os.path.join(root, 'answer.docx')])
+            imghash.save()
+            images = [(userids[i], member, h) for i in range(len(user_files))
+                      for member, h in hashes[i].items()]
+            groups = fingerprint.find_duplicates(
+                images, list(hashes[-1].values()), args.images)
+            fingerprint.write_report(
+                result_path, groups, len(images), args.images)
+            print('Images:', len(groups), 'groups of duplicate images.')
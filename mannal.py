@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+# Cache of MANNAL (manual) grading results.
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Callable
+
+try:
+    import fcntl
+except ImportError:  # not POSIX, a single writer is assumed
+    fcntl = None
+
+
+class MannalCache:
+    """
+    Scores typed in MANNAL mode, keyed by 'userid-taskid'.
+    result/mannal.json holds the compacted cache in the same format as before,
+    every new grade is appended as one JSON line to result/mannal.journal and
+    fsync'd, so a crash loses nothing and never leaves a half written file.
+    The journal is merged into mannal.json every `compact_every` grades and on close().
+    Any process may read the cache, only the writer holding the lock on the journal
+    repairs a line torn by a crash, readers skip it.
+    """
+
+    def __init__(self, result_path: str, compact_every: int = 200):
+        self.json_path = os.path.join(result_path, 'mannal.json')
+        self.journal_path = os.path.join(result_path, 'mannal.journal')
+        self.compact_every = compact_every
+        self.data = dict()
+        if os.path.exists(self.json_path):
+            with open(self.json_path, 'r') as f:
+                self.data = json.load(f)
+        self.appended = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # being written by another process, or torn by a crash
+                        break
+                    try:
+                        key, value = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        continue
+                    self.data[key] = value
+                    self.appended += 1
+        self.journal = None
+
+    def open_journal(self):
+        # open the journal for appending, as the only writer
+        self.journal = open(self.journal_path, 'a+b')
+        if fcntl is not None:
+            fcntl.flock(self.journal, fcntl.LOCK_EX)
+        size = self.journal.seek(0, os.SEEK_END)
+        if size > 0:
+            self.journal.seek(size-1)
+            if self.journal.read(1) != b'\n':
+                # the tail of a crashed writer, cut after its last complete line
+                self.journal.seek(0)
+                data = self.journal.read()
+                self.journal.truncate(data.rfind(b'\n')+1)
+
+    def __contains__(self, key: str):
+        return key in self.data
+
+    def __getitem__(self, key: str):
+        return self.data[key]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __setitem__(self, key: str, value):
+        if self.journal is None:
+            self.open_journal()
+        self.journal.write(
+            (json.dumps([key, value], ensure_ascii=False)+'\n').encode('utf-8'))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.data[key] = value
+        self.appended += 1
+        if self.appended >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        # mannal.json is replaced atomically before the journal is emptied
+        if self.journal is None:
+            self.open_journal()
+        tmp = self.json_path+'.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.json_path)
+        self.journal.truncate(0)
+        self.appended = 0
+
+    def close(self):
+        if self.appended > 0:
+            self.compact()
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+caches = dict()  # result_path -> MannalCache
+
+
+def open_cache(result_path: str):
+    """
+    return:       the MannalCache of result_path, loaded once per process
+    """
+    path = os.path.abspath(result_path)
+    if path not in caches:
+        caches[path] = MannalCache(path)
+    return caches[path]
+
+
+class Prefetcher:
+    """
+    Prepares the next `depth` items in background threads while the grader
+    is scoring the current one, e.g. decoding and resizing their images.
+    Items must be requested in order with get(k).
+    """
+
+    def __init__(self, items: List, prepare: Callable, depth: int = 4, threads: int = 2):
+        self.items = items
+        self.prepare = prepare
+        self.depth = depth
+        self.pool = ThreadPoolExecutor(threads) if depth > 0 else None
+        self.futures = dict()
+
+    def get(self, k: int):
+        """
+        return:       prepare(items[k])
+        """
+        if self.pool is None:
+            return self.prepare(self.items[k])
+        for j in range(k, min(k+self.depth+1, len(self.items))):
+            if j not in self.futures:
+                self.futures[j] = self.pool.submit(
+                    self.prepare, self.items[j])
+        return self.futures.pop(k).result()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_images(imgs: List):
+    for img in imgs:
+        img.load()
+
+
+def release_images(imgs: List):
+    for img in imgs:
+        img.release()
+
+
+def group_key(task, text: str, imgs: List):
+    # answers with images are never merged, screenshots differ even when the text is the same
+    if len(imgs) > 0:
+        return None
+    return ' '.join(task.normalize(text).split())
+
+
+def grade_groups(items: List[Tuple], result_path: str, prefetch: int = 4):
+    """
+    Grade pending MANNAL items task by task, showing each distinct answer once
+    and giving the typed score to every student of the group.
+    items:        List[Tuple[userfile,userid,Task,text,imgs]]
+    prefetch:     number of groups prepared ahead in background threads
+    return:       number of prompts
+    """
+    cache = open_cache(result_path)
+    groups = dict()  # (taskid, ('text', normalized text) or ('img', userid)) -> items, tasks in order of first appearance
+    order = dict()
+    for item in items:
+        userfile, userid, task, text, imgs = item
+        if userid+'-'+task.taskid in cache:
+            continue
+        key = group_key(task, text, imgs)
+        order.setdefault(task.taskid, len(order))
+        key = ('text', key) if key is not None else ('img', userid)
+        groups.setdefault((task.taskid, key), []).append(item)
+    groups = sorted(groups.values(), key=lambda g: (order[g[0][2].taskid], -len(g)))
+
+    def prepare(k: int):
+        userfile, userid, task, text, imgs = groups[k][0]
+        title = f'[{k+1}/{len(groups)}] {len(groups[k])} student(s): ' + \
+            ' '.join(item[1] for item in groups[k])
+        load_images(imgs)
+        return task.render(title, text)
+    with Prefetcher(list(range(len(groups))), prepare, prefetch) as prefetcher:
+        for k, group in enumerate(groups):
+            userfile, userid, task, text, imgs = group[0]
+            rendered = prefetcher.get(k)
+            score = task.ask_score(userfile, None, text, imgs, rendered)
+            release_images(imgs)
+            for userfile, userid, task, text, imgs in group:
+                cache[userid+'-'+task.taskid] = task.result_line(text, score)
+    return len(groups)
+
+
+def close_all():
+    for cache in caches.values():
+        cache.close()
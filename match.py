@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 import re
+import sys
 import time
+import bisect
 
 from numba import jit
 import numpy as np
 
 
-@jit(nopython=True)
+@jit(nopython=True, cache=True)
 def DP(A, B):
     w = [3, -1]
     a, b = (-2, -1)
@@ -53,8 +55,357 @@ def DP(A, B):
     return ans, match
 
 
-def match(A, B, name1='str1', name2='str2'):
-    ans, match = DP(A, B)
+@jit(nopython=True, cache=True)
+def BandedDP(A, B, band):
+    """
+    Same scoring and tie-breaking as DP, but only the cells whose diagonal
+    j-i lies in [min(0,m-n)-band, max(0,m-n)+band] are evaluated.
+    Only two score rows are kept, the traceback of row i is stored from its
+    first cell in the band, so memory is O((n+m)+n*min(m,|n-m|+2*band))
+    instead of O(n*m).
+    return: (score, match, clipped), clipped when the traceback touches an
+            edge of the band or a path leaving it could score as much,
+            otherwise the result is identical to DP
+    """
+    w = [3, -1]
+    a, b = (-2, -1)
+    n, m = len(A), len(B)
+    NEG = -(1 << 40)
+    # diagonals beyond [-n, m] hold no cell
+    kmin = max(-n, min(0, m-n)-band)
+    kmax = min(m, max(0, m-n)+band)
+    W = min(kmax-kmin, m)+1
+    # direction: 0 diagonal, 1 vertical gap from row src, 2 horizontal gap from column src
+    # cell (i, j) is stored at [i, j-max(0, i+kmin)]
+    dirs = np.zeros((n+1, W), np.uint8)
+    src = np.zeros((n+1, W), np.int32)
+    prev = np.full(m+1, NEG, np.int64)
+    cur = np.full(m+1, NEG, np.int64)
+    gu_score = np.full(m+1, NEG, np.int64)
+    gu_row = np.zeros(m+1, np.int32)
+    prev[0] = 0
+    for j in range(1, kmax+1):
+        prev[j] = a+b*j
+        dirs[0, j] = 2
+        gu_score[j] = prev[j]
+    for i in range(1, n+1):
+        lo = max(0, i+kmin)
+        hi = min(m, i+kmax)
+        if lo == 0:
+            cur[0] = a+b*i
+            dirs[i, 0] = 1
+            src[i, 0] = 0
+            gv_score, gv_col = cur[0], 0
+        else:
+            # left of the band, read as the diagonal of the next row
+            cur[lo-1] = NEG
+            gv_score, gv_col = NEG, 0
+        for j in range(max(1, lo), hi+1):
+            o0 = w[1]+prev[j-1] if A[i-1] != B[j-1] else w[0]+prev[j-1]
+            o1 = gu_score[j]+a+b*i
+            o2 = gv_score+a+b*j
+            k = j-lo
+            if o0 >= o1 and o0 >= o2:
+                best = o0
+                dirs[i, k] = 0
+            elif o1 >= o2:
+                best = o1
+                dirs[i, k] = 1
+                src[i, k] = gu_row[j]
+            else:
+                best = o2
+                dirs[i, k] = 2
+                src[i, k] = gv_col
+            cur[j] = best
+            if best-b*i > gu_score[j]:
+                gu_score[j] = best-b*i
+                gu_row[j] = i
+            if best-b*j > gv_score:
+                gv_score, gv_col = best-b*j, j
+        prev, cur = cur, prev
+    match = [(A[0:0], B[0:0])]
+    match.pop()
+    clipped = False
+    x, y = n, m
+    while(x > 0 or y > 0):
+        if (y-x == kmin and kmin > -n) or (y-x == kmax and kmax < m):
+            clipped = True
+        k = y-max(0, x+kmin)
+        d = dirs[x, k]
+        if d == 0:
+            match.append((A[x-1], B[y-1]))
+            x, y = x-1, y-1
+        elif d == 1:
+            nx = src[x, k]
+            for i in range(x, nx, -1):
+                match.append((A[i-1], B[0:0]))
+            x = nx
+        else:
+            ny = src[x, k]
+            for i in range(y, ny, -1):
+                match.append((A[0:0], B[i-1]))
+            y = ny
+    match.reverse()
+    ans = prev[m]
+    # a path through the diagonal k has at least |k|+|m-n-k| gap characters and
+    # at most (n+m-gaps)/2 pairs, no path leaving the band scores more than bound
+    gaps = n+m+1
+    if kmin > -n:
+        gaps = min(gaps, abs(kmin-1)+abs(m-n-kmin+1))
+    if kmax < m:
+        gaps = min(gaps, abs(kmax+1)+abs(m-n-kmax-1))
+    if gaps <= n+m:
+        bound = w[0]*min(n, m, (n+m-gaps)//2)+a+b*gaps
+        if ans <= bound:
+            clipped = True
+    return ans, match, clipped
+
+
+def banded_align(A, B, band=256):
+    """
+    BandedDP, with the band doubled while it clips the alignment,
+    at worst the band covers the whole matrix, the result is always DP's.
+    """
+    while True:
+        if abs(len(A)-len(B))+2*band >= len(B):
+            # the band already spans whole rows, the exact matrix costs no more
+            band = len(A)+len(B)
+        ans, match, clipped = BandedDP(A, B, band)
+        if not clipped:
+            return ans, match
+        band = 2*band+1
+
+
+# traceback codes of ArrayDP
+TRACE_DIAG, TRACE_UP, TRACE_LEFT = 0, 1, 2
+TRACE_STATE = 3
+TRACE_UP_EXTEND = 4
+TRACE_LEFT_EXTEND = 8
+
+
+@jit(nopython=True, cache=True)
+def ArrayDP(A, B):
+    """
+    Same scoring and tie-breaking as DP on integer code arrays (see encode).
+    The affine gaps are split into Gotoh's states: H best score, E vertical
+    gap, F horizontal gap. Only one row of each is kept as int32, the
+    traceback is a single uint8 per cell: the state H came from in the low
+    bits and whether E/F extended an open gap in TRACE_*_EXTEND.
+    return: (score, index of A or -1 per pair, index of B or -1 per pair)
+    """
+    w0, w1 = 3, -1
+    a, b = (-2, -1)
+    n, m = A.shape[0], B.shape[0]
+    NEG = -(1 << 29)
+    trace = np.zeros((n+1, m+1), np.uint8)
+    H = np.empty(m+1, np.int32)
+    E = np.full(m+1, NEG, np.int32)
+    H[0] = 0
+    for j in range(1, m+1):
+        H[j] = a+b*j
+        trace[0, j] = TRACE_LEFT | (TRACE_LEFT_EXTEND if j > 1 else 0)
+    for i in range(1, n+1):
+        diag = H[0]
+        H[0] = a+b*i
+        trace[i, 0] = TRACE_UP | (TRACE_UP_EXTEND if i > 1 else 0)
+        F = NEG
+        ai = A[i-1]
+        for j in range(1, m+1):
+            code = 0
+            # vertical gap, H[j] still holds row i-1
+            e = E[j]+b
+            if e >= H[j]+a+b:
+                code |= TRACE_UP_EXTEND
+            else:
+                e = H[j]+a+b
+            E[j] = e
+            # horizontal gap, H[j-1] already holds row i
+            f = F+b
+            if f >= H[j-1]+a+b:
+                code |= TRACE_LEFT_EXTEND
+            else:
+                f = H[j-1]+a+b
+            F = f
+            best = diag+(w0 if ai == B[j-1] else w1)
+            state = TRACE_DIAG
+            if e > best:
+                best = e
+                state = TRACE_UP
+            if f > best:
+                best = f
+                state = TRACE_LEFT
+            diag = H[j]
+            H[j] = best
+            trace[i, j] = code | state
+    ia = np.empty(n+m, np.int32)
+    ib = np.empty(n+m, np.int32)
+    L = 0
+    x, y, state = n, m, TRACE_DIAG
+    while x > 0 or y > 0:
+        t = trace[x, y]
+        if state == TRACE_DIAG:
+            state = t & TRACE_STATE
+        if state == TRACE_DIAG:
+            ia[L], ib[L] = x-1, y-1
+            x, y = x-1, y-1
+        elif state == TRACE_UP:
+            ia[L], ib[L] = x-1, -1
+            x -= 1
+            if not t & TRACE_UP_EXTEND:
+                state = TRACE_DIAG
+        else:
+            ia[L], ib[L] = -1, y-1
+            y -= 1
+            if not t & TRACE_LEFT_EXTEND:
+                state = TRACE_DIAG
+        L += 1
+    return H[m], ia[:L][::-1], ib[:L][::-1]
+
+
+def encode(s):
+    """
+    return: np.ndarray of the unicode code points of s
+    """
+    return np.frombuffer(s.encode('utf-32-le'), dtype=np.uint32)
+
+
+def array_align(A, B):
+    ans, ia, ib = ArrayDP(encode(A), encode(B))
+    match = [(A[x] if x >= 0 else '', B[y] if y >= 0 else '')
+             for x, y in zip(ia.tolist(), ib.tolist())]
+    return int(ans), match
+
+
+ENGINES = ['dp', 'banded', 'array']
+
+
+def align(A, B, engine='dp', band=256):
+    """
+    engine: 'dp'     full O(n*m) matrices
+            'banded' diagonal band of half width `band` around the main diagonals,
+                     widened while the alignment may leave it
+            'array'  full matrix of one byte per cell, see ArrayDP
+    return: (score, List[Tuple[str,str]])
+    """
+    if len(A) == 0 or len(B) == 0:
+        # trivial alignment, and keeps numba away from untyped empty lists
+        a, b = (-2, -1)
+        ans = a+b*(len(A)+len(B)) if len(A)+len(B) > 0 else 0
+        return ans, [(c, '') for c in A]+[('', c) for c in B]
+    if engine == 'dp':
+        return DP(A, B)
+    elif engine == 'banded':
+        return banded_align(A, B, band)
+    elif engine == 'array':
+        return array_align(A, B)
+    else:
+        raise NotImplementedError(engine)
+
+
+def warmup(engines=ENGINES):
+    """
+    Compile the kernels of the engines, numba stores them in __pycache__
+    so later processes only load the machine code.
+    """
+    for engine in engines:
+        align('warm', 'up', engine)
+
+
+def kgram_index(S, k):
+    """
+    return: Dict[kgram, position], -1 for k-grams occurring more than once
+    """
+    index = dict()
+    for i in range(len(S)-k+1):
+        g = S[i:i+k]
+        index[g] = -1 if g in index else i
+    return index
+
+
+def find_anchors(A, B, k=24, margin=8, min_coverage=0.3):
+    """
+    Exact-match anchors between A and B: k-grams that occur exactly once in
+    both strings, extended to maximal common substrings, chained so that both
+    positions increase, and shrunk by `margin` characters on each side so that
+    the gap alignment still sees some context.
+    return: List[Tuple[a_begin, b_begin, length]], or None when the anchors are
+            too sparse or too ambiguous to trust (chain covers < min_coverage of B)
+    """
+    if len(A) < k or len(B) < k:
+        return None
+    index_a = kgram_index(A, k)
+    index_b = kgram_index(B, k)
+    seeds = sorted((pa, index_b[g]) for g, pa in index_a.items()
+                   if pa >= 0 and index_b.get(g, -1) >= 0)
+    # merge seeds lying on the same diagonal and extend to maximal matches
+    runs = []
+    for pa, pb in seeds:
+        if len(runs) > 0:
+            x, y, l = runs[-1]
+            if pa-x == pb-y and pa <= x+l:
+                continue
+        l = 0
+        while pa+l < len(A) and pb+l < len(B) and A[pa+l] == B[pb+l]:
+            l += 1
+        while pa > 0 and pb > 0 and A[pa-1] == B[pb-1]:
+            pa, pb, l = pa-1, pb-1, l+1
+        runs.append((pa, pb, l))
+    # longest chain with increasing positions in B (runs are sorted by A)
+    tails, tails_idx, parent = [], [], [-1]*len(runs)
+    for i, (x, y, l) in enumerate(runs):
+        p = bisect.bisect_left(tails, y)
+        parent[i] = tails_idx[p-1] if p > 0 else -1
+        if p == len(tails):
+            tails.append(y)
+            tails_idx.append(i)
+        else:
+            tails[p] = y
+            tails_idx[p] = i
+    chain = []
+    i = tails_idx[-1] if len(tails_idx) > 0 else -1
+    while i != -1:
+        chain.append(runs[i])
+        i = parent[i]
+    chain.reverse()
+    # cut overlaps and keep some context around each anchor
+    anchors = []
+    end_a, end_b = 0, 0
+    for x, y, l in chain:
+        cut = max(end_a-x, end_b-y, 0)
+        x, y, l = x+cut+margin, y+cut+margin, l-cut-2*margin
+        if l > 0:
+            anchors.append((x, y, l))
+            end_a, end_b = x+l+margin, y+l+margin
+    if sum(l for x, y, l in anchors) < min_coverage*len(B):
+        return None
+    return anchors
+
+
+def anchored_align(A, B, engine='dp', band=256):
+    """
+    Align only the gaps between exact-match anchors, falling back to a
+    single alignment of the whole strings when no reliable anchors exist.
+    The returned score is the sum of the segment scores.
+    """
+    anchors = find_anchors(A, B)
+    if anchors is None:
+        return align(A, B, engine, band)
+    ans, match = 0, []
+    pa, pb = 0, 0
+    for x, y, l in anchors+[(len(A), len(B), 0)]:
+        s, m = align(A[pa:x], B[pb:y], engine, band)
+        ans += s+3*l
+        match += m
+        match += [(A[x+i], B[y+i]) for i in range(l)]
+        pa, pb = x+l, y+l
+    return ans, match
+
+
+def match(A, B, name1='str1', name2='str2', engine='dp', band=256, anchor=False):
+    if anchor:
+        ans, match = anchored_align(A, B, engine, band)
+    else:
+        ans, match = align(A, B, engine, band)
     result = str(ans)
     # out = open('./match.txt', 'w')
     # step = 60  # format print
@@ -66,3 +417,51 @@ def match(A, B, name1='str1', name2='str2'):
     # out.close()
     # print('result :', result)
     return match
+
+
+if __name__ == '__main__':
+    # Equivalence check of all alignment engines on the sample submissions,
+    # or `python match.py --compile` to build the kernel cache ahead of time
+    import os
+    import glob
+    import argparse
+    import docxparser
+    import main
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workdir', type=str, default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'template'), help='working folder path.')
+    parser.add_argument('--band', type=int, default=256,
+                        help='half width of the diagonal band.')
+    parser.add_argument('--compile', action='store_true',
+                        help='only compile every engine into the on-disk cache.')
+    args = parser.parse_args()
+    if args.compile:
+        t = time.time()
+        warmup()
+        print(f'compiled {",".join(ENGINES)} in {time.time()-t:.3f}s')
+        sys.exit(0)
+    answer, _ = docxparser.process(os.path.join(args.workdir, 'answer.docx'))
+    template_str, task_address = main.split_template(answer)
+    ok = True
+    for user_file in sorted(glob.glob(os.path.join(args.workdir, 'data', '*.docx'))):
+        user_input, _ = docxparser.process(user_file)
+        name = os.path.basename(user_file)
+        results = dict()
+        for engine in ENGINES+['anchor']:
+            t = time.time()
+            if engine == 'anchor':
+                results[engine] = anchored_align(user_input, template_str)
+            else:
+                results[engine] = align(
+                    user_input, template_str, engine, args.band)
+            print(f'{name}\t{engine}\tscore:{results[engine][0]}\t{time.time()-t:.3f}s')
+        for engine in ENGINES[1:]:
+            if results[engine] != results['dp']:
+                print('  MISMATCH:', engine)
+                ok = False
+        # segmented alignment may break ties differently, only the per-task text has to agree
+        if main.split_pair(results['anchor'][1], task_address) != main.split_pair(results['dp'][1], task_address):
+            print('  MISMATCH: anchor')
+            ok = False
+    print('OK' if ok else 'FAILED')
+    sys.exit(0 if ok else 1)
@@ -1,12 +1,50 @@
 # coding:utf-8
+# Server of the md5 named logs (settings.json longTermLog).
+#   python network.py                 one process per connection
+#   python network.py --async [-p 8083] [--cache-mb 64]
+#                                     asyncio, HTTP/1.1 keep-alive, LRU cache of rendered pages, ETag/304
+#   python network.py --pack result/log
+#                                     serve the pages stored in result/log.pack (logstore.py) instead of files
 import os
+import gzip
 import socket
 import re
+import asyncio
+import argparse
+from collections import OrderedDict
 
 from multiprocessing import Process
 
+from logpage import render_html, accepts_gzip
+
 # 设置静态文件根目录
 HTML_ROOT_DIR = "./log/"
+# logstore.LogStore, read instead of HTML_ROOT_DIR if set
+LOG_STORE = None
+SERVER_NAME = "Computer Science Foundation Homework Server"
+
+
+def is_md5(md5):
+    return len(md5) == 32 and md5.isalnum()
+
+
+def render_page(file_data):
+    """
+    file_data:    bytes of a log
+    return:       str, the HTML page of the log
+    """
+    return render_html(str(file_data, "utf-8"))
+
+
+def read_log(md5):
+    """
+    return:       bytes of a log file, None if there is no such log
+    """
+    try:
+        with open(os.path.join(HTML_ROOT_DIR, md5), "rb") as file:
+            return file.read()
+    except IOError:
+        return None
 
 
 def handle_client(client_socket):
@@ -29,40 +67,43 @@ def handle_client(client_socket):
         file_name = "/index.html"
 
     md5 = file_name[1:]
-    response_headers = "Computer Science Foundation Homework Server\r\n"
-    if len(md5) != 32 or not md5.isalnum():
+    response_headers = SERVER_NAME+"\r\n"
+    page = None
+    if not is_md5(md5):
         response_start_line = "HTTP/1.1 404 Not Found\r\n"
         response_body = "404 not found!"
     else:
         # 打开文件，读取内容
         try:
-            file = open(os.path.join(HTML_ROOT_DIR, md5), "rb")
-        except IOError:
-            response_start_line = "HTTP/1.1 404 Not Found\r\n"
-            response_body = "404 not found!"
+            page = load_page(md5)
+        except UnicodeDecodeError:
+            response_start_line = "HTTP/1.1 500 Internal Server Error\r\n"
+            response_body = "500 internal server error!"
         else:
-            file_data = file.read()
-            file.close()
-
-            # 构造响应数据
-            response_start_line = "HTTP/1.1 200 OK\r\n"
-            response_body = '<html><head><meta http-equiv="content-type" content="txt/html; charset=utf-8" /><title>Homework</title></head><body><pre>' + \
-                file_data.decode("utf-8") + '</pre></body></html>'
+            if page is None:
+                response_start_line = "HTTP/1.1 404 Not Found\r\n"
+                response_body = "404 not found!"
+            else:
+                # 构造响应数据
+                response_start_line = "HTTP/1.1 200 OK\r\n"
+                response_body = ""
 
     response = response_start_line + response_headers + "\r\n" + response_body
     print("response data:", response)
 
     # 向客户端返回响应数据
     client_socket.send(bytes(response, "utf-8"))
+    if page is not None:
+        client_socket.sendall(page)
 
     # 关闭客户端连接
     client_socket.close()
 
 
-if __name__ == "__main__":
+def serve_fork(port):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind(("", 8083))
+    server_socket.bind(("", port))
     server_socket.listen(128)
 
     while True:
@@ -72,3 +113,171 @@ if __name__ == "__main__":
             target=handle_client, args=(client_socket,))
         handle_client_process.start()
         client_socket.close()
+
+
+class PageCache:
+    """
+    LRU cache of rendered pages: md5 -> utf-8 bytes, at most `capacity` bytes in total.
+    A log never changes once written, its name is its md5.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.pages = OrderedDict()
+
+    def get(self, md5):
+        page = self.pages.get(md5)
+        if page is not None:
+            self.pages.move_to_end(md5)
+        return page
+
+    def put(self, md5, page):
+        if len(page) > self.capacity:
+            return
+        if md5 in self.pages:
+            self.size -= len(self.pages.pop(md5))
+        self.pages[md5] = page
+        self.size += len(page)
+        while self.size > self.capacity:
+            self.size -= len(self.pages.popitem(last=False)[1])
+
+
+def load_page(md5):
+    # utf-8 bytes of the page, None if there is no such log
+    if LOG_STORE is not None:
+        # the page rendered when the log was packed
+        page = LOG_STORE.view(md5, page=True)
+        return gzip.decompress(page) if page is not None else None
+    file_data = read_log(md5)
+    if file_data is None:
+        return None
+    return render_page(file_data).encode("utf-8")
+
+
+class AsyncServer:
+    """
+    Serve GET/HEAD /{md5} on keep-alive connections, pages are rendered once and kept in a PageCache.
+    """
+
+    max_header = 16384
+
+    def __init__(self, cache_bytes, timeout=15.0):
+        self.cache = PageCache(cache_bytes)
+        self.timeout = timeout
+
+    async def page(self, md5):
+        page = self.cache.get(md5)
+        if page is None:
+            # read the file in a thread, a slow disk never blocks the other connections
+            page = await asyncio.get_running_loop().run_in_executor(None, load_page, md5)
+            if page is not None:
+                self.cache.put(md5, page)
+        return page
+
+    async def respond(self, method, target, headers):
+        """
+        return:       (status line, extra headers, body)
+        """
+        if method not in ("GET", "HEAD"):
+            return "405 Method Not Allowed", [("Allow", "GET, HEAD")], b"405 method not allowed!"
+        md5 = target.split("?")[0][1:]
+        if not is_md5(md5):
+            return "404 Not Found", [], b"404 not found!"
+        extra = [("Content-Type", "text/html; charset=utf-8")]
+        # a strong validator of each content-coding
+        etag = '"'+md5+'"'
+        cache_headers = [("Cache-Control", "public, max-age=86400")]
+        page = None
+        if LOG_STORE is not None:
+            cache_headers.append(("Vary", "Accept-Encoding"))
+            if accepts_gzip(headers.get("accept-encoding", "")):
+                # the gzipped page is sent straight from the mapped pack
+                page = LOG_STORE.view(md5, page=True)
+                if page is not None:
+                    etag = '"'+md5+'-gz"'
+                    extra.append(("Content-Encoding", "gzip"))
+        if page is None:
+            page = await self.page(md5)
+        if page is None:
+            return "404 Not Found", [], b"404 not found!"
+        cache_headers.append(("ETag", etag))
+        if etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+            return "304 Not Modified", cache_headers, b""
+        return "200 OK", cache_headers + extra, page
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                request_line = lines[0].split()
+                if len(request_line) != 3:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                method, target, version = request_line
+                headers = dict()
+                for line in lines[1:]:
+                    if ":" in line:
+                        key, value = line.split(":", 1)
+                        headers[key.strip().lower()] = value.strip()
+                length = headers.get("content-length", "0")
+                if not length.isdigit():
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                if int(length) > 0:
+                    await reader.readexactly(int(length))
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                try:
+                    status, extra, body = await self.respond(method, target, headers)
+                except Exception as e:
+                    # e.g. a log which is not utf-8, the connection is closed after the answer
+                    print("error:", target, repr(e))
+                    status, extra, body = "500 Internal Server Error", [], b"500 internal server error!"
+                    keep_alive = False
+                response = [f"HTTP/1.1 {status}", f"Server: {SERVER_NAME}",
+                            f"Content-Length: {len(body)}",
+                            "Connection: " + ("keep-alive" if keep_alive else "close")]
+                response += [f"{key}: {value}" for key, value in extra]
+                writer.write(("\r\n".join(response)+"\r\n\r\n").encode("latin-1"))
+                if method != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port):
+        server = await asyncio.start_server(self.handle, "", port, backlog=1024, limit=self.max_header)
+        print(f"Serving {LOG_STORE.pack_path if LOG_STORE is not None else HTML_ROOT_DIR} on port {port}")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--port", type=int, default=8083)
+    parser.add_argument("--root", type=str, default=HTML_ROOT_DIR,
+                        help="folder of the logs.")
+    parser.add_argument("--pack", type=str, default=None,
+                        help="packed log store, result/log for result/log.pack.")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="asyncio server with keep-alive and a page cache instead of a process per connection.")
+    parser.add_argument("--cache-mb", type=int, default=64,
+                        help="memory of the page cache of --async in MB.")
+    args = parser.parse_args()
+    HTML_ROOT_DIR = args.root
+    if args.pack is not None:
+        from logstore import LogStore
+        LOG_STORE = LogStore(args.pack)
+    if args.use_async:
+        asyncio.run(AsyncServer(args.cache_mb*2**20).serve(args.port))
+    else:
+        serve_fork(args.port)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import hashlib
+
+
+def file_hash(path: str, chunk_size: int = 1 << 20):
+    m = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+class ParseCache:
+    """
+    Per-submission cache of step 1 (docx parsing and alignment).
+    Every result is a pickle in `folder` named by the hash of the docx bytes
+    and the hash of the answer template together with the alignment options,
+    so an added or changed submission only costs its own alignment.
+    """
+
+    suffix = '.pkl'
+    # bump when the format of step 1 results changes
+    version = 2
+
+    def __init__(self, folder: str, answer: str, options: tuple = ()):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        m = hashlib.sha1()
+        m.update(repr((self.version, answer, options)).encode('utf-8'))
+        self.template_hash = m.hexdigest()
+
+    def key(self, user_file: str):
+        return file_hash(user_file)+'-'+self.template_hash
+
+    def path(self, key: str):
+        return os.path.join(self.folder, key+self.suffix)
+
+    def load(self, key: str):
+        # return None if missing or unreadable
+        try:
+            with open(self.path(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def save(self, key: str, result):
+        # write to a temporary file first, a crash never leaves a truncated entry
+        path = self.path(key)
+        tmp = path+'.'+str(os.getpid())+'.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(tmp, path)
+
+    def evict(self, keys):
+        # remove every entry that is not in keys, return the number of removed entries
+        keep = set(k+self.suffix for k in keys)
+        removed = 0
+        for name in os.listdir(self.folder):
+            if name not in keep:
+                os.remove(os.path.join(self.folder, name))
+                removed += 1
+        return removed
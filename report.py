@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# Output of step 3: result.xls (and optionally .xlsx/.csv) filled from template.xls, the md5 named logs
+# and statistics.txt/statistics.json.
+import os
+import csv
+import json
+import gzip
+import hashlib
+import argparse
+from collections import Counter
+from typing import List, Dict
+
+import xlwt
+
+from logpage import render_html
+from logstore import LogStore
+
+try:
+    import openpyxl
+except ImportError:  # .xlsx output is optional
+    openpyxl = None
+
+FORMATS = ['xls', 'xlsx', 'csv']
+SCORE_COLUMN = 4
+LOG_COLUMN = 5
+
+
+def log_md5(log: str):
+    m = hashlib.md5()
+    m.update(str.encode(log))
+    return m.hexdigest()
+
+
+def replace_file(path: str, data: bytes):
+    # write to a temporary file first, a crash never leaves a truncated file behind its name
+    tmp = path+'.'+str(os.getpid())+'.tmp'
+    with open(tmp, 'wb') as w:
+        w.write(data)
+    os.replace(tmp, path)
+
+
+def publish_log(log_path: str, md5: str, log: str):
+    """
+    Render the log to {md5}.html once, with {md5}.html.gz beside it,
+    so the web server only streams a file.
+    """
+    page = render_html(log).encode('utf-8')
+    replace_file(os.path.join(log_path, md5+'.html'), page)
+    # mtime=0: the same log always gives the same bytes
+    replace_file(os.path.join(log_path, md5+'.html.gz'),
+                 gzip.compress(page, mtime=0))
+
+
+def write_log(log_path: str, log: str, existing: set = None):
+    """
+    Since the log is usually very large, the log will be written to the file named by its md5,
+    and published as HTML by publish_log.
+    A log already in log_path is not written again, the name is its content.
+    existing:     names in log_path, checked instead of the file system
+    return:       md5
+    """
+    md5 = log_md5(log)
+    path = os.path.join(log_path, md5)
+    if (md5 in existing) if existing is not None else os.path.exists(path):
+        return md5
+    # the raw log last, it marks the log as published
+    publish_log(log_path, md5, log)
+    replace_file(path, str.encode(log, encoding='utf-8'))
+    if existing is not None:
+        existing.add(md5)
+    return md5
+
+
+class LogFolder:
+    """
+    The logs of an assignment as files, result/log/<md5> written by write_log.
+    logstore.LogStore keeps them in a single pack with the same put().
+    """
+
+    def __init__(self, log_path: str):
+        if not os.path.exists(log_path):
+            os.makedirs(log_path)
+        self.log_path = log_path
+        self.existing = set(os.listdir(log_path))
+
+    def put(self, log: str):
+        """
+        return:       md5
+        """
+        return write_log(self.log_path, log, self.existing)
+
+
+def open_logs(result_path: str, pack: bool = False):
+    """
+    return:       where the logs of result_path are written, logstore.LogStore or LogFolder
+    """
+    path = os.path.join(result_path, 'log')
+    return LogStore(path) if pack else LogFolder(path)
+
+
+def student_index(studentID: List[str]):
+    """
+    return:       Dict:{studentID: index of its first file}, as studentID.index
+    """
+    index = dict()
+    for i in range(len(studentID)):
+        index.setdefault(studentID[i], i)
+    return index
+
+
+def result_rows(rsheet, studentID: List[str], result: List[Dict], logs, long_term_log: str):
+    """
+    Rows of template.xls with the score and the log link filled in for every submitted student.
+    rsheet:       xlrd sheet of template.xls, column 1 is the student ID
+    result:       Dict:{'score':float,'md5':str} or Dict:{'score':float,'log':str} of each file
+    logs:         LogFolder or logstore.LogStore, where the logs are written
+    return:       List[List], every row is padded to the log column
+    """
+    index = student_index(studentID)
+    width = max(rsheet.ncols, LOG_COLUMN+1)
+    rows = []
+    for i in range(rsheet.nrows):
+        row = rsheet.row_values(i)
+        row += ['']*(width-len(row))
+        k = index.get(row[1])
+        if k is not None:
+            D = result[k]
+            md5 = D['md5'] if 'md5' in D else logs.put(D['log'])
+            row[SCORE_COLUMN] = D['score']
+            row[LOG_COLUMN] = long_term_log.replace('{md5}', md5)
+        rows.append(row)
+    return rows
+
+
+def write_xls(path: str, sheet_name: str, rows: List[List]):
+    wbk = xlwt.Workbook()
+    wsheet = wbk.add_sheet(sheet_name)
+    for i in range(len(rows)):
+        wrow = wsheet.row(i)
+        for j, value in enumerate(rows[i]):
+            wrow.write(j, value)
+    wbk.save(path)
+
+
+def write_xlsx(path: str, sheet_name: str, rows: List[List]):
+    assert openpyxl is not None, '.xlsx output needs openpyxl: pip install openpyxl'
+    # write_only streams the rows, the whole sheet is never kept in memory
+    wbk = openpyxl.Workbook(write_only=True)
+    wsheet = wbk.create_sheet(sheet_name)
+    for row in rows:
+        wsheet.append(row)
+    wbk.save(path)
+
+
+def write_csv(path: str, sheet_name: str, rows: List[List]):
+    # utf-8 with BOM, so that Excel detects the encoding of the names
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        csv.writer(f).writerows(rows)
+
+
+writers = {'xls': write_xls, 'xlsx': write_xlsx, 'csv': write_csv}
+
+
+def write_result(result_path: str, logs, rsheet, studentID: List[str], result: List[Dict], long_term_log: str,
+                 formats: List[str] = ('xls',)):
+    """
+    Write result.{format} for every format in formats.
+    """
+    rows = result_rows(rsheet, studentID, result, logs, long_term_log)
+    for fmt in formats:
+        writers[fmt](os.path.join(result_path, 'result.'+fmt), rsheet.name, rows)
+
+
+class Statistics:
+    """
+    Per-task indexes updated while scoring, so every report is written in one pass:
+    the wrong answers with their students, the score distribution and the answer_cache counters.
+    A worker process fills its own Statistics and the main process merges them in order.
+    """
+
+    def __init__(self):
+        self.wrong = dict()  # taskid -> {user_input: [studentID]}, in order of first appearance
+        self.scores = dict()  # taskid -> Counter{score: students}
+        self.cache = dict()  # taskid -> [hits,misses] of answer_cache
+        self.total = 0.0
+
+    def add_wrong(self, userid: str, taskid: str, text: str):
+        studentID = os.path.basename(userid).split('_')[0]
+        self.wrong.setdefault(taskid, dict()).setdefault(
+            text, []).append(studentID)
+
+    def add_score(self, userid: str, taskid: str, score: float):
+        self.scores.setdefault(taskid, Counter())[score] += 1
+        self.total += score
+
+    def add_cache(self, taskid: str, hit: bool):
+        self.cache.setdefault(taskid, [0, 0])[0 if hit else 1] += 1
+
+    def merge(self, other):
+        for taskid, answers in other.wrong.items():
+            D = self.wrong.setdefault(taskid, dict())
+            for text, studentIDs in answers.items():
+                D.setdefault(text, []).extend(studentIDs)
+        for taskid, counter in other.scores.items():
+            self.scores.setdefault(taskid, Counter()).update(counter)
+        for taskid, (hits, misses) in other.cache.items():
+            counter = self.cache.setdefault(taskid, [0, 0])
+            counter[0] += hits
+            counter[1] += misses
+        self.total += other.total
+
+    def wrong_cases(self, taskid: str):
+        # (user_input, studentIDs), the most common first
+        return sorted(self.wrong.get(taskid, dict()).items(), key=lambda x: -len(x[1]))
+
+    def task_summary(self, task):
+        """
+        return:       Dict:{'score','count','mean','pass_rate','distribution'}, a student passes with the full score
+        """
+        counter = self.scores.get(task.taskid, Counter())
+        count = sum(counter.values())
+        return {'score': task.score,
+                'count': count,
+                'mean': sum(k*v for k, v in counter.items())/count if count > 0 else 0.0,
+                'pass_rate': sum(v for k, v in counter.items() if k >= task.score)/count if count > 0 else 0.0,
+                'distribution': sorted(counter.items(), key=lambda x: -x[0])}
+
+    def write(self, result_path: str, tasks: List, files: int):
+        """
+        Write statistics.txt and statistics.json.
+        files:        number of submitted files, the denominator of the average score
+        """
+        average = self.total/files
+        wrong_list = [self.wrong_cases(task.taskid) for task in tasks]
+        summaries = [self.task_summary(task) for task in tasks]
+        with open(os.path.join(result_path, 'statistics.txt'), 'w') as w:
+            w.write('Average Score:'+str(average)+'\n')
+            w.write('Wrong Case:\n')
+            for i in range(len(tasks)):
+                if len(wrong_list[i]) > 0:
+                    w.write('  Task:'+str(tasks[i].taskid)+'\n')
+                    for text, userids in wrong_list[i]:
+                        w.write(f"    {repr(text)}:\t"+str(len(userids))+'\n')
+            w.write('Details Wrong Case:\n')
+            w.write('Wrong Case:\n')
+            for i in range(len(tasks)):
+                if len(wrong_list[i]) > 0:
+                    w.write('  Task:'+str(tasks[i].taskid)+'\n')
+                    for text, userids in wrong_list[i]:
+                        w.write(f"    {repr(text)}:\t"+str(userids)+'\n')
+            if len(self.cache) > 0:
+                w.write('Answer Cache (hits/total):\n')
+                for task in tasks:
+                    if task.taskid in self.cache:
+                        hits, misses = self.cache[task.taskid]
+                        w.write(f'  Task:{task.taskid}\t{hits}/{hits+misses}\n')
+            w.write('Score Distribution (mean, pass rate, score:students):\n')
+            for task, D in zip(tasks, summaries):
+                if D['count'] > 0:
+                    distribution = ' '.join(
+                        f'{k}:{v}' for k, v in D['distribution'])
+                    w.write(
+                        f"  Task:{task.taskid}\t{D['mean']:.2f}/{task.score}\t{D['pass_rate']:.1%}\t{distribution}\n")
+        tasks_json = dict()
+        for task, wrong, D in zip(tasks, wrong_list, summaries):
+            D['distribution'] = {str(k): v for k, v in D['distribution']}
+            D['wrong'] = [{'answer': text, 'students': userids}
+                          for text, userids in wrong]
+            if task.taskid in self.cache:
+                D['cache'] = dict(zip(['hits', 'misses'], self.cache[task.taskid]))
+            tasks_json[task.taskid] = D
+        with open(os.path.join(result_path, 'statistics.json'), 'w', encoding='utf-8') as w:
+            json.dump({'average': average, 'files': files, 'tasks': tasks_json},
+                      w, ensure_ascii=False, indent=1)
+
+
+def publish_folder(log_path: str):
+    """
+    Publish the logs written before publish_log existed.
+    return:       number of published logs
+    """
+    names = set(os.listdir(log_path))
+    published = 0
+    for md5 in names:
+        if len(md5) == 32 and md5+'.html.gz' not in names:
+            with open(os.path.join(log_path, md5), 'rb') as f:
+                publish_log(log_path, md5, f.read().decode('utf-8'))
+            published += 1
+    return published
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    p = subparsers.add_parser(
+        'publish', help='render the unpublished logs of a log folder to .html and .html.gz.')
+    p.add_argument('log_path', type=str, help='result/log folder.')
+    args = parser.parse_args()
+    print('publish:', publish_folder(args.log_path), 'logs')
@@ -1,2 +1,2 @@
 cd web
-python3 manage.py runserver 0:8083
+PYTHONPATH=.. python3 manage.py runserver 0:8083
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Near-identical submissions across the class: MinHash signatures of the per-task answers of step 1,
+# LSH buckets for candidate pairs, and the alignment of match.py to check every candidate.
+import os
+import zlib
+from typing import List, Tuple, Dict
+
+import numpy as np
+from numba import jit
+
+import match
+
+# hashes are uint64 arithmetic modulo 2**64, the overflow is the modulo
+BASE = np.uint64(1000003)
+
+
+def normalize(text: str):
+    return ' '.join(text.lower().split())
+
+
+def distinct(h: np.ndarray):
+    # sorted distinct values, np.unique without its overhead on small arrays
+    h = np.sort(h)
+    return h[np.concatenate(([True], h[1:] != h[:-1]))] if len(h) > 0 else h
+
+
+def kgram_hashes(taskid: str, text: str, k: int = 5):
+    """
+    text:         normalized answer
+    return:       np.ndarray, the hash of the k-gram starting at each position of text,
+                  a k-gram only matches the same k-gram of the same task
+    """
+    c = match.encode(text).astype(np.uint64)
+    if len(c) < k:
+        return np.zeros(0, dtype=np.uint64)
+    # polynomial hash of every k-gram, vectorized over the positions
+    h = np.full(len(c)-k+1, zlib.crc32(taskid.encode('utf-8')), dtype=np.uint64)
+    for j in range(k):
+        h = h*BASE+c[j:len(c)-k+1+j]
+    return h
+
+
+def shingles(answers: List[Tuple[str, str]], k: int = 5):
+    """
+    answers:      List[(taskid, answer)]
+    return:       np.ndarray of the distinct hashes of the character k-grams
+    """
+    hashes = [kgram_hashes(taskid, normalize(text), k)
+              for taskid, text in answers]
+    hashes = [h for h in hashes if len(h) > 0]
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return distinct(np.concatenate(hashes))
+
+
+@jit(nopython=True, cache=True)
+def minhash(hashes, a, b):
+    """
+    return: np.ndarray, min over hashes of the upper 32 bits of a[i]*x+b[i] (mod 2**64) for each i
+    """
+    sig = np.full(len(a), 2**32, dtype=np.uint64)
+    for x in hashes:
+        for i in range(len(a)):
+            v = (a[i]*x+b[i]) >> np.uint64(32)
+            if v < sig[i]:
+                sig[i] = v
+    return sig
+
+
+class MinHashIndex:
+    """
+    MinHash signatures of `bands`*`rows` multiply-shift hash functions, split into bands for LSH:
+    two sets of Jaccard similarity s share a bucket with probability 1-(1-s**rows)**bands.
+    """
+
+    def __init__(self, bands: int = 32, rows: int = 4, seed: int = 0):
+        self.bands = bands
+        self.rows = rows
+        rnd = np.random.RandomState(seed)
+        # odd multipliers, the upper 32 bits of a*x+b (mod 2**64) are the hash
+        self.a = rnd.randint(0, 2**63, size=bands*rows, dtype=np.uint64)*np.uint64(2)+np.uint64(1)
+        self.b = rnd.randint(0, 2**63, size=bands*rows, dtype=np.uint64)
+        self.buckets = dict()  # (band, signature rows) -> [key]
+        self.signatures = dict()  # key -> signature
+
+    def add(self, key, hashes: np.ndarray):
+        sig = minhash(hashes, self.a, self.b)
+        self.signatures[key] = sig
+        for band in range(self.bands):
+            rows = sig[band*self.rows:(band+1)*self.rows].tobytes()
+            self.buckets.setdefault((band, rows), []).append(key)
+
+    def candidates(self):
+        """
+        return:       set of (key, key) sharing at least one bucket
+        """
+        pairs = set()
+        for keys in self.buckets.values():
+            for i in range(len(keys)):
+                for j in range(i+1, len(keys)):
+                    pairs.add((keys[i], keys[j]))
+        return pairs
+
+    def jaccard(self, key1, key2):
+        # estimated Jaccard similarity
+        return float(np.mean(self.signatures[key1] == self.signatures[key2]))
+
+
+def aligned_similarity(A: str, B: str, engine: str = 'dp', band: int = 256):
+    # 2*(aligned equal characters)/(len(A)+len(B))
+    if len(A)+len(B) == 0:
+        return 1.0
+    _, pairs = match.align(A, B, engine, band)
+    same = sum(1 for a, b in pairs if a == b and a != '')
+    return 2*same/(len(A)+len(B))
+
+
+def is_common(common: np.ndarray, h: np.ndarray):
+    # h in the sorted array common
+    if len(common) == 0:
+        return np.zeros(len(h), dtype=bool)
+    return common[np.minimum(np.searchsorted(common, h), len(common)-1)] == h
+
+
+def own_text(answers: List[Tuple[str, str]], common: np.ndarray, k: int = 5):
+    """
+    The student-written part of the answers: the characters covered by a k-gram which
+    is not common, every run of them on its own line.
+    """
+    runs = []
+    for taskid, text in answers:
+        text = normalize(text)
+        h = kgram_hashes(taskid, text, k)
+        covered = np.zeros(len(text)+1, dtype=np.int32)
+        own = np.nonzero(~is_common(common, h))[0]
+        np.add.at(covered, own, 1)
+        np.add.at(covered, own+k, -1)
+        covered = np.cumsum(covered)[:len(text)] > 0
+        start = None
+        for i, c in enumerate(covered.tolist()+[False]):
+            if c and start is None:
+                start = i
+            elif not c and start is not None:
+                runs.append(text[start:i])
+                start = None
+    return '\n'.join(runs)
+
+
+def find_similar(submissions: Dict[str, List[Tuple[str, str]]], threshold: float = 0.8, k: int = 5,
+                 max_df: float = 0.5, engine: str = 'dp', band: int = 256):
+    """
+    submissions:  userid -> List[(taskid, answer)]
+    threshold:    minimum aligned similarity of a reported pair
+    max_df:       k-grams in more than this fraction of the submissions, the template
+                  and the common correct answers, are left out of the signatures and
+                  of the aligned texts
+    return:       List[Dict:{'users','jaccard','similarity','identical'}], the most similar first
+    """
+    users = sorted(submissions)
+    hashes = {userid: shingles(submissions[userid], k) for userid in users}
+    common = np.zeros(0, dtype=np.uint64)
+    if len(users) > 2:
+        values, counts = np.unique(np.concatenate(
+            [hashes[userid] for userid in users]), return_counts=True)
+        common = values[counts > max_df*len(users)]
+        hashes = {userid: h[~is_common(common, h)]
+                  for userid, h in hashes.items()}
+    index = MinHashIndex()
+    for userid in users:
+        if len(hashes[userid]) > 0:
+            index.add(userid, hashes[userid])
+    texts = dict()  # userid -> own_text, of the candidates only
+    report = []
+    for user1, user2 in sorted(index.candidates()):
+        for userid in (user1, user2):
+            if userid not in texts:
+                texts[userid] = own_text(submissions[userid], common, k)
+        similarity = aligned_similarity(
+            texts[user1], texts[user2], engine, band)
+        if similarity < threshold:
+            continue
+        identical = [taskid for (taskid, text1), (_, text2) in zip(submissions[user1], submissions[user2])
+                     if normalize(text1) == normalize(text2) and len(own_text([(taskid, text1)], common, k)) > 0]
+        jaccard = index.jaccard(user1, user2)
+        report.append({'users': (user1, user2), 'jaccard': jaccard,
+                       'similarity': similarity, 'identical': identical})
+    report.sort(key=lambda x: -x['similarity'])
+    return report
+
+
+def groups(report: List[Dict]):
+    # connected components of the reported pairs
+    parent = dict()
+
+    def find(x):
+        while parent.setdefault(x, x) != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+    for r in report:
+        parent[find(r['users'][0])] = find(r['users'][1])
+    components = dict()
+    for x in parent:
+        components.setdefault(find(x), []).append(x)
+    return sorted((sorted(c) for c in components.values()), key=lambda c: (-len(c), c))
+
+
+def write_report(result_path: str, report: List[Dict], submissions: int, threshold: float):
+    with open(os.path.join(result_path, 'similarity.txt'), 'w') as w:
+        w.write(f'Similar Submissions (aligned similarity >= {threshold}, {submissions} submissions):\n')
+        for group in groups(report):
+            w.write(f'  {len(group)}:\t'+' '.join(group)+'\n')
+        w.write('Pairs (similarity, estimated jaccard, identical tasks):\n')
+        for r in report:
+            w.write(f"  {r['users'][0]}\t{r['users'][1]}\t{r['similarity']:.3f}\t{r['jaccard']:.3f}\t" +
+                    ','.join(r['identical'])+'\n')
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Special judge (program/spj.py) executed in separate processes with time and memory limits.
+import os
+import sys
+import math
+import queue
+import types
+import subprocess
+import multiprocessing
+from multiprocessing.connection import Connection
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Dict
+
+try:
+    import resource
+except ImportError:  # not POSIX
+    resource = None
+
+
+def task_view(task):
+    """
+    Picklable copy of a Task for the judge process, which can not import
+    the Task class when the grader runs as a script.
+    """
+    state = {k: v for k, v in vars(task).items() if k != 'matcher'}
+    return types.SimpleNamespace(**state)
+
+
+class SPJExecutor:
+    """
+    A pool of judge processes running spj.run(taskid, input, task).
+    Every call has a wall-clock limit and every judge process an address
+    space limit (POSIX). A call which exceeds them scores 0 and the judge
+    process is restarted. Calls are sent to a judge in chunks, one round
+    trip per chunk, results come back one by one. If the judge defines
+    run_batch(taskid, inputs, task), a chunk of one task is judged by a
+    single run_batch call, and by run calls if that fails or times out.
+    """
+
+    def __init__(self, path: str, processes: int = 4, timeout: float = 10.0, memory: int = 0, batch: bool = False):
+        """
+        path:         program/spj.py
+        timeout:      seconds per call
+        memory:       MB per judge process, 0 for no limit
+        batch:        spj.py defines run_batch
+        """
+        self.path = os.path.abspath(path)
+        self.processes = processes
+        self.timeout = timeout
+        self.memory = memory
+        self.batch = batch
+        self.pid = os.getpid()
+        self.workers = queue.Queue()
+        for i in range(processes):
+            self.workers.put(self.start())
+
+    def start(self):
+        parent, child = multiprocessing.Pipe()
+        # a subprocess, because the grader may itself be a daemonic pool worker
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), self.path, str(self.memory), str(child.fileno())],
+                                pass_fds=(child.fileno(),))
+        child.close()
+        return proc, parent
+
+    def stop(self, worker):
+        proc, conn = worker
+        conn.close()
+        proc.kill()
+        proc.wait()
+
+    def restart(self, worker):
+        self.stop(worker)
+        return self.start()
+
+    def run_chunk(self, calls: List[Tuple]):
+        worker = self.workers.get()
+        results = []
+        try:
+            if self.batch and len(calls) > 1 and all(taskid == calls[0][0] for taskid, input, task in calls):
+                proc, conn = worker
+                conn.send(('batch', calls[0][0], [input for taskid, input, task in calls], calls[0][2]))
+                try:
+                    if conn.poll(self.timeout*len(calls)):
+                        batch = conn.recv()
+                        if batch is not None:
+                            return batch
+                    else:
+                        print(
+                            f'SPJ Task:{calls[0][0]}\tbatch of {len(calls)} exceeds the time limit, judge one by one')
+                        worker = self.restart(worker)
+                except EOFError:
+                    worker = self.restart(worker)
+            while len(results) < len(calls):
+                proc, conn = worker
+                rest = calls[len(results):]
+                conn.send(('run', rest))
+                for taskid, input, task in rest:
+                    error = None
+                    if conn.poll(self.timeout):
+                        try:
+                            results.append(conn.recv())
+                            continue
+                        except EOFError:
+                            error = 'Special judge crashed'
+                    else:
+                        error = f'Time limit exceeded ({self.timeout}s)'
+                    print(f'SPJ Task:{taskid}\t{error}\tinput:{input[:20]!r}')
+                    results.append({'score': 0.0, 'log': error})
+                    worker = self.restart(worker)
+                    break
+        finally:
+            self.workers.put(worker)
+        return results
+
+    def run_batch(self, calls: List[Tuple[str, str]], tasks: Dict[str, object]):
+        """
+        calls:        List[(taskid, input)]
+        tasks:        taskid -> Task
+        return:       List[Dict:{'score':float,'log':str}]
+        """
+        views = {taskid: task_view(task) for taskid, task in tasks.items()}
+        calls = [(taskid, input, views[taskid]) for taskid, input in calls]
+        size = max(1, math.ceil(len(calls)/(self.processes*4)))
+        if self.batch:
+            # one chunk of a single task per judge process, judged by run_batch
+            groups = dict()
+            for i in range(len(calls)):
+                groups.setdefault(calls[i][0], []).append(i)
+            chunks = []
+            for index in groups.values():
+                size = max(1, math.ceil(len(index)/self.processes))
+                chunks += [index[k:k+size]
+                           for k in range(0, len(index), size)]
+        else:
+            chunks = [list(range(k, min(k+size, len(calls))))
+                      for k in range(0, len(calls), size)]
+        with ThreadPoolExecutor(self.processes) as p:
+            judged = p.map(lambda index: self.run_chunk(
+                [calls[i] for i in index]), chunks)
+            results = [None]*len(calls)
+            for index, chunk_results in zip(chunks, judged):
+                for i, result in zip(index, chunk_results):
+                    results[i] = result
+        return results
+
+    def run(self, taskid: str, input: str, task):
+        return self.run_chunk([(taskid, input, task_view(task))])[0]
+
+    def close(self):
+        while not self.workers.empty():
+            self.stop(self.workers.get())
+
+
+def judge(spj, taskid: str, input: str, task):
+    try:
+        result = spj.run(taskid, input=input, task=task)
+        assert('score' in result)
+        return result
+    except Exception as e:
+        return {'score': 0.0, 'log': 'Special judge error: '+repr(e)}
+
+
+def judge_batch(spj, taskid: str, inputs: List[str], task):
+    # return None to let the executor fall back to single calls
+    try:
+        results = list(spj.run_batch(taskid, inputs, task))
+        assert(len(results) == len(inputs))
+        assert(all('score' in result for result in results))
+        return results
+    except Exception as e:
+        print(f'SPJ Task:{taskid}\trun_batch error: {e!r}, judge one by one')
+        return None
+
+
+def worker_main(path: str, memory: int, fd: int):
+    conn = Connection(fd)
+    if memory > 0 and resource is not None:
+        limit = memory*2**20
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    import importlib.util
+    spec = importlib.util.spec_from_file_location("spj", path)
+    spj = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(spj)
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message[0] == 'batch':
+            conn.send(judge_batch(spj, *message[1:]))
+        else:
+            for taskid, input, task in message[1]:
+                conn.send(judge(spj, taskid, input, task))
+
+
+if __name__ == '__main__':
+    # judge process started by SPJExecutor: spjpool.py {spj.py} {memory MB} {fd}
+    worker_main(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]))
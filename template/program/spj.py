@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import numpy as np
 
 
 def task9(text: str):
@@ -12,10 +13,30 @@ def task9(text: str):
         return {'score': 0.0, 'log': str(e)}
 
 
+def task9_batch(texts: list):
+    # the same check as task9, vectorized over every student's answer,
+    # objects keep the arbitrary precision of int like task9
+    values = np.zeros(len(texts), dtype=object)
+    errors = [None]*len(texts)
+    for i, text in enumerate(texts):
+        try:
+            values[i] = int(text)
+        except Exception as e:
+            errors[i] = str(e)
+    correct = (values > 0) & (values % 2 == 0)
+    return [{'score': 0.0, 'log': errors[i]} if errors[i] is not None else
+            {'score': 5.0, 'log': '√'} if correct[i] else
+            {'score': 0.0, 'log': '×'} for i in range(len(texts))]
+
+
 tasks = {
     '9': task9
 }
 
+batch_tasks = {
+    '9': task9_batch
+}
+
 
 def run(taskid: str, input: str, task: object):
     # main function of the spj module
@@ -24,3 +45,12 @@ def run(taskid: str, input: str, task: object):
     result = func(input)
     assert('score' in result and 'log' in result)
     return result
+
+
+def run_batch(taskid: str, inputs: list, task: object):
+    # optional, judge all students' answers of a task at once
+    if taskid not in batch_tasks:
+        return [run(taskid, input, task) for input in inputs]
+    results = batch_tasks[taskid](inputs)
+    assert(len(results) == len(inputs))
+    return results
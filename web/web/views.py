@@ -1,18 +1,71 @@
 import os
+import gzip
 
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseNotModified, FileResponse, Http404
+
+# logstore.py and logpage.py of the repository root, on PYTHONPATH (see runserver.sh),
+# neither needs more than the standard library
+from logstore import LogStore
+from logpage import render_html, accepts_gzip
 
 LOG_DIR = '../log/'
+# packed log store, ../log.pack and ../log.idx, used instead of LOG_DIR if it exists
+LOG_PACK = '../log'
+log_store = None
+
+
+def get_log_store():
+    global log_store
+    if log_store is None and os.path.exists(LOG_PACK+'.idx'):
+        log_store = LogStore(LOG_PACK)
+    return log_store
 
 
 def md5log(request, path):
-    try:
-        file = open(os.path.abspath(LOG_DIR+path), "rb")
-    except IOError:
+    """
+    Stream {md5}.html.gz (or {md5}.html) published by main.py,
+    the raw log is rendered on the fly if the log is not published.
+    With a packed store the gzipped page is a slice of the mapped pack.
+    """
+    root = os.path.abspath(LOG_DIR)
+    log = os.path.abspath(os.path.join(root, path))
+    if not log.startswith(root+os.sep):
+        raise Http404("Log not found")
+    gzip_ok = accepts_gzip(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    store = get_log_store()
+    page = store.view(os.path.basename(log), page=True) if store is not None else None
+    if page is None and not os.path.exists(log):
         raise Http404("Log not found")
+    # a log never changes, its name is its md5, the gzip page has a tag of its own
+    gzip_served = gzip_ok and (page is not None or os.path.exists(log+'.html.gz'))
+    etag = '"%s%s"' % (os.path.basename(log), '-gz' if gzip_served else '')
+    if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = HttpResponseNotModified()
+    elif page is not None:
+        if gzip_served:
+            response = HttpResponse(page, content_type='text/html; charset=utf-8')
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = HttpResponse(gzip.decompress(page), content_type='text/html; charset=utf-8')
+    elif gzip_served:
+        response = FileResponse(open(log+'.html.gz', 'rb'),
+                                content_type='text/html; charset=utf-8')
+        response['Content-Encoding'] = 'gzip'
+    elif os.path.exists(log+'.html'):
+        response = FileResponse(open(log+'.html', 'rb'),
+                                content_type='text/html; charset=utf-8')
     else:
-        file_data = file.read()
-        file.close()
-        response_body = '<html><head><meta http-equiv="content-type" content="txt/html; charset=utf-8" /><title>Homework</title></head><body><pre>' + \
-            file_data.decode("utf-8") + '</pre></body></html>'
-        return HttpResponse(response_body)
+        try:
+            file = open(log, "rb")
+        except IOError:
+            raise Http404("Log not found")
+        else:
+            file_data = file.read()
+            file.close()
+            response = HttpResponse(render_html(file_data.decode('utf-8')))
+    if 'Content-Disposition' in response:
+        del response['Content-Disposition']
+    response['ETag'] = etag
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response['Vary'] = 'Accept-Encoding'
+    return response